@@ -79,6 +79,8 @@ class AwoxMeshLight:
         self.btdevice = btle.Peripheral()
         self.session_key = None
         self.command_characteristic = None
+        self.pair_characteristic = None
+        self.status_characteristic = None
         self.mesh_name = mesh_name.encode()
         self.mesh_password = mesh_password.encode()
 
@@ -107,21 +109,26 @@ class AwoxMeshLight:
         self.btdevice.setDelegate(DelegateNotification())
         self.btdevice.connect(self.mac)
 
+        # characteristics are kept across reconnects, which skips the
+        # service discovery when pairing again
+        if not self.pair_characteristic:
+            self.pair_characteristic = self.btdevice.getCharacteristics(
+                uuid=CHARACTERISTIC_UUID_PAIR)[0]
+        if not self.status_characteristic:
+            self.status_characteristic = self.btdevice.getCharacteristics(
+                uuid=CHARACTERISTIC_UUID_STATUS)[0]
+
         # send pair message
-        pair_characteristic = self.btdevice.getCharacteristics(
-            uuid=CHARACTERISTIC_UUID_PAIR)[0]
         self.session_random = urandom(8)
         message = pckt.make_pair_packet(
             self.mesh_name, self.mesh_password, self.session_random)
-        pair_characteristic.write(message)
+        self.pair_characteristic.write(message)
 
         # get status (?)
-        status_characteristic = self.btdevice.getCharacteristics(
-            uuid=CHARACTERISTIC_UUID_STATUS)[0]
-        status_characteristic.write(b'\x01')
+        self.status_characteristic.write(b'\x01')
 
         # read pairing reply
-        reply = bytearray(pair_characteristic.read())
+        reply = bytearray(self.pair_characteristic.read())
         if reply[0] == 0xd:
             self.session_key = pckt.make_session_key(self.mesh_name, self.mesh_password,
                                                      self.session_random, reply[1:9])
@@ -257,6 +264,20 @@ class AwoxMeshLight:
         self.btdevice.disconnect()
         self.session_key = None
 
+    def forget_characteristics(self):
+        """ Discover the characteristics again on the next connect.
+        """
+        self.command_characteristic = None
+        self.pair_characteristic = None
+        self.status_characteristic = None
+
+    def replace_peripheral(self):
+        """ Use a new peripheral, once bluepy-helper of the current one died.
+        """
+        self.btdevice = btle.Peripheral()
+        self.session_key = None
+        self.forget_characteristics()
+
     def getFirmwareRevision(self):
         """
         Returns :
@@ -0,0 +1,226 @@
+import datetime
+import json
+import logging
+import os
+import queue
+import re
+from threading import Thread
+from time import monotonic, sleep
+from typing import Callable, Dict, List, Optional, Tuple
+
+from . import AwoxMeshLight, CHARACTERISTIC_UUID_OTA
+from . import packetutils as pckt
+from .supervisor import LINK_ERRORS
+
+#: Firmware bytes carried by one OTA packet.
+OTA_CHUNK_SIZE = 16
+
+#: Packets written without response before waiting for an acknowledgement.
+OTA_WINDOW = 8
+
+#: Longest pause between two windows while other commands are pending.
+OTA_MAX_YIELD = datetime.timedelta(seconds=2)
+
+OTA_YIELD_SLEEP = datetime.timedelta(milliseconds=20)
+
+#: Connection attempts per light before its update is given up.
+OTA_MAX_ATTEMPTS = 5
+
+OTA_RETRY_BACKOFF = datetime.timedelta(seconds=5)
+
+MAC_PATTERN = re.compile(r"^([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}$")
+
+logger = logging.getLogger(__name__)
+
+
+def split_firmware(firmware: bytes) -> List[bytes]:
+    return [firmware[i:i+OTA_CHUNK_SIZE]
+            for i in range(0, len(firmware), OTA_CHUNK_SIZE)]
+
+
+def parse_ota_request(payload: bytes, firmware_directory: str) -> Tuple[str, Dict[int, str]]:
+    """
+    Args :
+        payload: The update request, in the form
+            {"firmware": "<file name>", "lights": {"<light id>": "<mac>"}}
+        firmware_directory: The only directory firmware images are read from.
+
+    Returns :
+        The path of the firmware image and the mac per light id.
+
+    Raises :
+        ValueError: The request is malformed or the image is outside of the
+            firmware directory.
+    """
+    try:
+        request = json.loads(payload)
+        name = request["firmware"]
+        lights = {int(light_id): mac for light_id, mac in request["lights"].items()}
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError("malformed request: {!r}".format(e))
+    if not isinstance(name, str) or not name:
+        raise ValueError("firmware must be a file name")
+
+    directory = os.path.realpath(firmware_directory)
+    path = os.path.realpath(os.path.join(directory, name))
+    if os.path.dirname(path) != directory:
+        raise ValueError("firmware {} is outside of {}".format(name, directory))
+
+    for mac in lights.values():
+        if not isinstance(mac, str) or not MAC_PATTERN.match(mac):
+            raise ValueError("invalid mac {!r}".format(mac))
+    return path, lights
+
+
+class OtaUpload:
+    """
+    Streams a firmware image to a connected light, as indexed chunks on the
+    OTA characteristic.
+
+    Chunks are written without response, at most `window` of them are in
+    flight. Reading the characteristic afterwards only returns once the light
+    processed all writes before it, which acknowledges the whole window. After
+    a lost connection the upload resumes behind the last acknowledged chunk.
+    """
+
+    def __init__(self, light: AwoxMeshLight, firmware: bytes, window=OTA_WINDOW):
+        """
+        Args :
+            light: The light to update, connected directly.
+            firmware: The firmware image.
+            window: How many packets may be written without acknowledgement.
+        """
+        assert firmware, "firmware must not be empty"
+        assert window > 0, "window must be positive"
+        self.light = light
+        self.chunks = split_firmware(firmware)
+        self.window = window
+        #: Index of the last chunk the light acknowledged, -1 if none.
+        self.acked = -1
+        self.finished = False
+
+    @property
+    def total(self) -> int:
+        return len(self.chunks)
+
+    def run(self, idle: Optional[Callable[[], bool]] = None,
+            progress: Optional[Callable[[int, int], None]] = None):
+        """
+        Upload the chunks after the last acknowledged one.
+
+        Args :
+            idle: Returns False while other commands wait for the radio, the
+                upload then pauses between two windows.
+            progress: Called with the acknowledged chunks and the total after
+                every window.
+
+        Raises :
+            btle.BTLEException, OSError: The connection was lost, call again once the
+                light is connected.
+        """
+        characteristic = self.light.btdevice.getCharacteristics(
+            uuid=CHARACTERISTIC_UUID_OTA)[0]
+
+        while self.acked + 1 < self.total:
+            if idle is not None:
+                deadline = monotonic() + OTA_MAX_YIELD.total_seconds()
+                while not idle() and monotonic() < deadline:
+                    sleep(OTA_YIELD_SLEEP.total_seconds())
+
+            first = self.acked + 1
+            last = min(first + self.window, self.total) - 1
+            for index in range(first, last + 1):
+                characteristic.write(pckt.make_ota_packet(
+                    index, self.chunks[index]), withResponse=False)
+            characteristic.read()
+            self.acked = last
+
+            if progress is not None:
+                progress(self.acked + 1, self.total)
+
+        characteristic.write(pckt.make_ota_end_packet(
+            self.total - 1), withResponse=False)
+        characteristic.read()
+        self.finished = True
+
+
+class OtaScheduler:
+    """
+    Updates lights one after another in a background thread. Every light is
+    connected on its own, the connection of the bridge to its gateway keeps
+    carrying commands, and the upload leaves the radio to them while they are
+    pending.
+    """
+
+    def __init__(self, mesh_name: str, mesh_password: str,
+                 idle: Optional[Callable[[], bool]] = None,
+                 on_status: Optional[Callable[[str, str, int, int], None]] = None,
+                 light_factory: Callable = AwoxMeshLight):
+        """
+        Args :
+            mesh_name: The mesh name as a string.
+            mesh_password: The mesh password as a string.
+            idle: See OtaUpload.run.
+            on_status: Called with the mac, the state ("uploading", "done" or
+                "failed"), the acknowledged chunks and the total.
+            light_factory: Creates the light for a mac, for tests.
+        """
+        self.mesh_name = mesh_name
+        self.mesh_password = mesh_password
+        self.idle = idle
+        self.on_status = on_status
+        self.light_factory = light_factory
+        self.jobs = queue.Queue()
+        self.thread = Thread(target=self._run, name="ota", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def enqueue(self, mac: str, firmware: bytes):
+        self.jobs.put((mac, firmware))
+
+    def _status(self, mac: str, state: str, upload: OtaUpload):
+        if self.on_status is not None:
+            self.on_status(mac, state, upload.acked + 1, upload.total)
+
+    def update(self, mac: str, firmware: bytes) -> bool:
+        """
+        Returns :
+            True if the light acknowledged the whole firmware.
+        """
+        light = self.light_factory(mac, self.mesh_name, self.mesh_password)
+        upload = OtaUpload(light, firmware)
+
+        for attempt in range(OTA_MAX_ATTEMPTS):
+            if attempt:
+                sleep(OTA_RETRY_BACKOFF.total_seconds())
+            try:
+                if not light.connect_with_callback(lambda _handle, _data: None):
+                    continue
+                logger.info("[%s] Uploading firmware from chunk %i of %i.",
+                            mac, upload.acked + 1, upload.total)
+                upload.run(self.idle, lambda _acked, _total: self._status(
+                    mac, "uploading", upload))
+            except LINK_ERRORS as e:
+                logger.warning("[%s] Firmware upload interrupted: %s", mac, e)
+                light.forget_characteristics()
+            finally:
+                try:
+                    light.disconnect()
+                except LINK_ERRORS:
+                    pass
+            if upload.finished:
+                break
+
+        state = "done" if upload.finished else "failed"
+        logger.info("[%s] Firmware upload %s.", mac, state)
+        self._status(mac, state, upload)
+        return upload.finished
+
+    def _run(self):
+        while True:
+            mac, firmware = self.jobs.get()
+            try:
+                self.update(mac, firmware)
+            except Exception:
+                logger.exception("[%s] Firmware upload failed", mac)
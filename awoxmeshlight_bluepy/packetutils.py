@@ -136,12 +136,43 @@ def make_session_key(mesh_name, mesh_password, session_random, response_random):
     return key
 
 
+def _make_crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for i in range(0, 8):
+            crc = (crc >> 1) ^ (0xa001 if crc & 0x1 else 0)
+        table.append(crc)
+    return table
+
+
+CRC16_TABLE = _make_crc16_table()
+
+
 def crc16(array):
-    poly_array = [0x0, 0xa001]
     crc = 0xffff
     for val in bytearray(array):
-        for i in range(0, 8):
-            ind = (crc ^ val) & 0x1
-            crc = (crc >> 1) ^ poly_array[ind]
-            val = val >> 1
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ val) & 0xff]
     return crc
+
+
+def make_ota_packet(index, chunk):
+    """
+    Args :
+        index: The index of the firmware chunk, as a number.
+        chunk: Up to 16 bytes of the firmware image, padded with 0xff.
+
+    Returns :
+        The 20 bytes packet for the OTA characteristic: the index, the chunk
+        and the crc16 of both, in little endian order.
+    """
+    packet = struct.pack("<H", index) + bytes(chunk).ljust(16, b'\xff')
+    return packet + struct.pack("<H", crc16(packet))
+
+
+def make_ota_end_packet(last_index):
+    """
+    Args :
+        last_index: The index of the last firmware chunk, as a number.
+    """
+    return struct.pack("<HHH", 0xff02, last_index, ~last_index & 0xffff)
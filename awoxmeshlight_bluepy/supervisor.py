@@ -0,0 +1,138 @@
+import datetime
+import logging
+from collections import OrderedDict
+from time import monotonic
+from typing import Callable, Hashable
+
+from bluepy import btle
+
+#: A dying bluepy-helper surfaces as a broken pipe instead of a BTLEException.
+LINK_ERRORS = (btle.BTLEException, OSError)
+
+logger = logging.getLogger(__name__)
+
+
+class MeshLightSupervisor:
+    """
+    Keeps the connection to a light alive. A lost connection is detected on
+    the next read or write and reestablished with bounded exponential backoff.
+    Commands issued in the meantime are buffered, only the newest command per
+    key survives and commands older than the expiry are dropped.
+    """
+
+    def __init__(self, light, callback: Callable,
+                 min_backoff=datetime.timedelta(seconds=1),
+                 max_backoff=datetime.timedelta(seconds=60),
+                 command_expiry=datetime.timedelta(seconds=30)):
+        """
+        Args :
+            light: The AwoxMeshLight to supervise.
+            callback: The notification callback, see AwoxMeshLight.connect_with_callback.
+            min_backoff: Delay before the first reconnect attempt.
+            max_backoff: Upper bound of the delay between reconnect attempts.
+            command_expiry: How long a buffered command stays valid.
+        """
+        self.light = light
+        self.callback = callback
+        self.min_backoff = min_backoff.total_seconds()
+        self.max_backoff = max_backoff.total_seconds()
+        self.command_expiry = command_expiry.total_seconds()
+
+        self.connected = False
+        self.backoff = self.min_backoff
+        self.next_attempt = 0.0
+        self.disconnected_at = None
+        #: Seconds from losing the connection to the last recovery.
+        self.last_recovery = None
+        self.buffer = OrderedDict()
+
+    def connect(self) -> bool:
+        try:
+            self.connected = bool(
+                self.light.connect_with_callback(self.callback))
+        except LINK_ERRORS as e:
+            logger.warning("[%s] Connecting failed: %s", self.light.mac, e)
+            self.light.forget_characteristics()
+            self.connected = False
+            # the peripheral may be connected while pairing failed
+            self._disconnect(e)
+
+        if self.connected:
+            if self.disconnected_at is not None:
+                self.last_recovery = monotonic() - self.disconnected_at
+                logger.info("[%s] Recovered after %.1f seconds.", self.light.mac,
+                            self.last_recovery)
+            self.disconnected_at = None
+            self.backoff = self.min_backoff
+            self._replay()
+        else:
+            if self.disconnected_at is None:
+                self.disconnected_at = monotonic()
+            self.next_attempt = monotonic() + self.backoff
+            logger.info("[%s] Next connection attempt in %.1f seconds.",
+                        self.light.mac, self.backoff)
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+        return self.connected
+
+    def _lost(self, e: Exception):
+        logger.warning("[%s] Connection lost: %s", self.light.mac, e)
+        self.connected = False
+        self.disconnected_at = monotonic()
+        self.next_attempt = monotonic() + self.backoff
+        self._disconnect(e)
+
+    def _disconnect(self, e: Exception):
+        try:
+            self.light.disconnect()
+        except LINK_ERRORS:
+            pass
+        if isinstance(e, OSError):
+            # a peripheral never recovers from its bluepy-helper dying
+            logger.info("[%s] Replacing the peripheral.", self.light.mac)
+            self.light.replace_peripheral()
+
+    def poll(self, timeout: float):
+        """
+        Wait for notifications, or attempt a reconnect once it is due.
+        """
+        if not self.connected:
+            if monotonic() >= self.next_attempt:
+                self.connect()
+            return
+
+        try:
+            self.light.btdevice.waitForNotifications(timeout=timeout)
+        except LINK_ERRORS as e:
+            self._lost(e)
+
+    def execute(self, key: Hashable, func: Callable, *args):
+        """
+        Run a command, or buffer it while the connection is down.
+
+        Args :
+            key: Commands with the same key replace each other in the buffer.
+            func: The command to run.
+            args: The arguments of the command.
+        """
+        if self.connected:
+            try:
+                func(*args)
+                return
+            except LINK_ERRORS as e:
+                self._lost(e)
+
+        self.buffer.pop(key, None)
+        self.buffer[key] = (monotonic() + self.command_expiry, func, args)
+
+    def _replay(self):
+        buffered, self.buffer = self.buffer, OrderedDict()
+        now = monotonic()
+        replayed = 0
+        for key, (deadline, func, args) in buffered.items():
+            if deadline < now:
+                continue
+            self.execute(key, func, *args)
+            replayed += 1
+        if buffered:
+            logger.info("[%s] Replayed %i of %i buffered commands.",
+                        self.light.mac, replayed, len(buffered))
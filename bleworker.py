@@ -0,0 +1,174 @@
+import datetime
+import logging
+import struct
+from multiprocessing import Process
+from threading import Lock
+from time import monotonic, sleep, time
+
+import awoxmeshlight_bluepy
+from awoxmeshlight_bluepy.supervisor import MeshLightSupervisor
+from ringbuffer import RingBuffer
+
+WORKER_RING_CAPACITY = 1024
+WORKER_QUEUE_SLEEP_DURATION = datetime.timedelta(milliseconds=25)
+WORKER_NOTIFICATION_TIMEOUT = datetime.timedelta(milliseconds=50)
+WORKER_COMMAND_TIMEOUT = datetime.timedelta(milliseconds=10)
+WORKER_BACKPRESSURE_SLEEP = datetime.timedelta(milliseconds=1)
+#: A worker dying again within this interval isn't restarted right away.
+WORKER_RESTART_INTERVAL = datetime.timedelta(seconds=5)
+
+# command, destination, length of data, data (max. 10 bytes)
+COMMAND_RECORD = struct.Struct("<BHB10s")
+# kind, receive timestamp, decrypted packet or link state
+NOTIFICATION_RECORD = struct.Struct("<Bd20s")
+KIND_NOTIFICATION = 0
+#: The first byte of the data holds whether the gateway is connected.
+KIND_LINK = 1
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(mac, mesh_name, mesh_password, commands: RingBuffer, notifications: RingBuffer):
+    """
+    Entry point of the worker process. Owns the bluetooth connection to the
+    gateway light, encrypts commands and decrypts notifications.
+    """
+    light = awoxmeshlight_bluepy.AwoxMeshLight(mac, mesh_name, mesh_password)
+    dropped = 0
+
+    def handle_notification(_cHandle, data: bytearray):
+        nonlocal dropped
+        message = light.decrypt_packet(data)
+        if message is None:
+            return
+        if not notifications.put(NOTIFICATION_RECORD.pack(
+                KIND_NOTIFICATION, time(), bytes(message))):
+            dropped += 1
+            logger.warning(
+                "Notification ring full, dropped {} notifications.".format(dropped))
+
+    supervisor = MeshLightSupervisor(light, handle_notification)
+    supervisor.connect()
+    reported = None
+
+    while True:
+        # the mqtt side reports the link of the gateway, not of the process
+        if supervisor.connected != reported and notifications.put(NOTIFICATION_RECORD.pack(
+                KIND_LINK, time(), bytes([supervisor.connected]))):
+            reported = supervisor.connected
+
+        supervisor.poll(WORKER_NOTIFICATION_TIMEOUT.total_seconds())
+
+        record = commands.get(timeout=WORKER_COMMAND_TIMEOUT.total_seconds())
+        if record is None:
+            continue
+
+        command, dest, length, data = COMMAND_RECORD.unpack(record)
+        supervisor.execute((command, dest), light.writeCommand,
+                           command, data[:length], dest)
+
+        sleep(WORKER_QUEUE_SLEEP_DURATION.total_seconds())
+
+
+class RemoteMeshLight:
+    """
+    Stand-in for AwoxMeshLight on the MQTT side of the worker process.
+    Commands are handed to the worker through a shared memory ring.
+
+    A dead worker is restarted on the next command or receive, at most once
+    per restart interval.
+    """
+
+    def __init__(self, mac, mesh_name="unpaired", mesh_password="1234", target=run_worker):
+        """
+        Args :
+            target: The entry point of the worker process, for tests.
+        """
+        self.mac = mac
+        self.mesh_id = 0
+        self.mesh_name = mesh_name
+        self.mesh_password = mesh_password
+        self.target = target
+        self.commands = RingBuffer(
+            WORKER_RING_CAPACITY, COMMAND_RECORD.size + 2)
+        self.notifications = RingBuffer(
+            WORKER_RING_CAPACITY, NOTIFICATION_RECORD.size + 2)
+        #: Whether the worker is connected to the gateway light.
+        self.connected = False
+        self.restarts = 0
+        self.started_at = None
+        self.lock = Lock()
+        self.process = self._make_process()
+
+    def _make_process(self) -> Process:
+        return Process(target=self.target, daemon=True, args=(
+            self.mac, self.mesh_name, self.mesh_password, self.commands, self.notifications))
+
+    def start(self):
+        self.started_at = monotonic()
+        self.process.start()
+
+    def ensure_alive(self) -> bool:
+        """
+        Returns :
+            False if the worker is dead and can't be restarted yet.
+        """
+        with self.lock:
+            if self.started_at is None or self.process.is_alive():
+                return True
+            self.connected = False
+            if monotonic() - self.started_at < WORKER_RESTART_INTERVAL.total_seconds():
+                return False
+            self.restarts += 1
+            logger.error("[{}] Worker process died with exit code {}, restart {}.".format(
+                self.mac, self.process.exitcode, self.restarts))
+            self.process = self._make_process()
+            self.start()
+            return True
+
+    def receive(self, timeout: datetime.timedelta):
+        """
+        Returns :
+            The receive timestamp and decrypted packet of the next
+            notification, or None if there was none within the timeout. Link
+            state records only update `connected` and return None as well.
+        """
+        record = self.notifications.get(timeout=timeout.total_seconds())
+        if record is None:
+            self.ensure_alive()
+            return None
+        kind, timestamp, data = NOTIFICATION_RECORD.unpack(record)
+        if kind == KIND_LINK:
+            self.connected = bool(data[0])
+            return None
+        return timestamp, data
+
+    def writeCommand(self, command, data, dest=None):
+        if dest == None:
+            dest = self.mesh_id
+        record = COMMAND_RECORD.pack(command, dest, len(data), data)
+        # block the caller instead of dropping commands, as long as there
+        # is a worker consuming them
+        while not self.commands.put(record):
+            if not self.ensure_alive():
+                logger.error("[{}] Worker process down, dropping command {}.".format(
+                    self.mac, command))
+                return
+            sleep(WORKER_BACKPRESSURE_SLEEP.total_seconds())
+
+    def close(self):
+        self.process.kill()
+        self.commands.close()
+        self.notifications.close()
+
+    # the command helpers only build data and call writeCommand
+    setColor = awoxmeshlight_bluepy.AwoxMeshLight.setColor
+    setColorBrightness = awoxmeshlight_bluepy.AwoxMeshLight.setColorBrightness
+    setSequenceColorDuration = awoxmeshlight_bluepy.AwoxMeshLight.setSequenceColorDuration
+    setSequenceFadeDuration = awoxmeshlight_bluepy.AwoxMeshLight.setSequenceFadeDuration
+    setPreset = awoxmeshlight_bluepy.AwoxMeshLight.setPreset
+    setWhiteBrightness = awoxmeshlight_bluepy.AwoxMeshLight.setWhiteBrightness
+    setWhiteTemperature = awoxmeshlight_bluepy.AwoxMeshLight.setWhiteTemperature
+    setWhite = awoxmeshlight_bluepy.AwoxMeshLight.setWhite
+    on = awoxmeshlight_bluepy.AwoxMeshLight.on
+    off = awoxmeshlight_bluepy.AwoxMeshLight.off
@@ -0,0 +1,180 @@
+import hashlib
+import json
+from typing import Dict, Iterable, Optional, Tuple
+
+from meshconfig import MeshConfig
+
+#: Identifies the bridge as the origin of the discovery payloads.
+ORIGIN = {"name": "awox-mqtt"}
+
+SUPPORTED_COLOR_MODES = ["rgb", "color_temp"]
+
+#: Hands the entity of a former per entity config over to the device config.
+MIGRATE_PAYLOAD = '{"migrate_discovery":true}'
+
+
+def serialize(payload: dict) -> str:
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+
+def payload_hash(payload: str) -> str:
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def device_topic(object_id: str) -> str:
+    return "homeassistant/device/{}/config".format(object_id)
+
+
+def legacy_light_topic(unique_id: str) -> str:
+    """
+    Topic of the former per entity discovery config, cleared on migration.
+    """
+    return "homeassistant/light/{}/config".format(unique_id)
+
+
+def light_config(mesh: MeshConfig, light_id: int, device: dict) -> Tuple[str, str]:
+    """
+    Build the device based discovery config of a light. The device block is
+    sent once for all components and availability is shared between them.
+
+    Returns :
+        The discovery topic and the serialized payload.
+    """
+    unique_id = "{}{}".format(mesh.unique_id_prefix, light_id)
+    dev = {
+        "ids": [unique_id],
+        "name": device["displayName"],
+        "mf": device["vendor"],
+        "mdl": device["modelName"],
+        "sw": device["version"],
+        "hw": device["hardwareVersion"],
+    }
+    # if we're not handling the gateway, add the via_device option to device info,
+    # lights of a mesh without a configured gateway are announced without it
+    if mesh.gateway_light_id is not None and light_id != mesh.gateway_light_id:
+        dev["via_device"] = "{}{}".format(
+            mesh.unique_id_prefix, mesh.gateway_light_id)
+
+    payload = {
+        "~": "homeassistant/light/{}".format(unique_id),
+        "dev": dev,
+        "o": ORIGIN,
+        "avty_t": "~/availability",
+        "cmps": {
+            unique_id: {
+                "p": "light",
+                "uniq_id": unique_id,
+                # only the device name is relevant
+                "name": None,
+                "schema": "json",
+                "cmd_t": "~/set",
+                "stat_t": "~/state",
+                "brightness": True,
+                "sup_clrm": SUPPORTED_COLOR_MODES,
+            }
+        },
+    }
+    return device_topic(unique_id), serialize(payload)
+
+
+def diagnostics_topic(mesh: MeshConfig, instance_id: Optional[str] = None) -> str:
+    if not instance_id:
+        return "{}/bridge/diagnostics".format(mesh.topic_prefix)
+    return "{}/bridge/{}/diagnostics".format(mesh.topic_prefix, instance_id)
+
+
+def group_components(mesh: MeshConfig, group_addresses: Iterable[int]) -> Dict[str, dict]:
+    components = dict()
+    for address in sorted(group_addresses):
+        unique_id = "{}group_{}".format(mesh.unique_id_prefix, address)
+        components[unique_id] = {
+            "p": "light",
+            "uniq_id": unique_id,
+            "name": "Group {}".format(address),
+            "schema": "json",
+            "cmd_t": "{}/group/{}/set".format(mesh.topic_prefix, address),
+            "brightness": True,
+            "sup_clrm": SUPPORTED_COLOR_MODES,
+        }
+    return components
+
+
+def bridge_config(mesh: MeshConfig, group_addresses: Iterable[int],
+                  instance_id: Optional[str] = None) -> Tuple[str, str]:
+    """
+    Build the discovery config of the bridge device of a mesh, with its
+    diagnostic sensors and a light per mesh group.
+
+    Args :
+        group_addresses: The mesh groups, empty for the bridge device of an
+            instance, see groups_config.
+        instance_id: The bridge instance, every instance announces its own
+            bridge device.
+
+    Returns :
+        The discovery topic and the serialized payload.
+    """
+    # the plain ids are kept for a single instance
+    suffix = "_{}".format(instance_id) if instance_id else ""
+    object_id = "{}bridge{}".format(mesh.unique_id_prefix, suffix)
+    diagnostics = {
+        "stat_t": diagnostics_topic(mesh, instance_id),
+        "ent_cat": "diagnostic",
+    }
+
+    components: Dict[str, dict] = {
+        object_id + "_connected": dict(diagnostics, **{
+            "p": "binary_sensor",
+            "uniq_id": object_id + "_connected",
+            "name": "Gateway link",
+            "dev_cla": "connectivity",
+            "val_tpl": "{{ 'ON' if value_json.connected else 'OFF' }}",
+        }),
+        object_id + "_lights": dict(diagnostics, **{
+            "p": "sensor",
+            "uniq_id": object_id + "_lights",
+            "name": "Known lights",
+            "val_tpl": "{{ value_json.lights }}",
+        }),
+        object_id + "_dropped": dict(diagnostics, **{
+            "p": "sensor",
+            "uniq_id": object_id + "_dropped",
+            "name": "Dropped notifications",
+            "stat_cla": "total_increasing",
+            "val_tpl": "{{ value_json.dropped }}",
+        }),
+    }
+    components.update(group_components(mesh, group_addresses))
+
+    payload = {
+        "dev": {
+            "ids": [object_id],
+            "name": "AwoX mesh {}{}".format(
+                mesh.id or mesh.name, " ({})".format(instance_id) if instance_id else ""),
+            "mf": "awox-mqtt",
+        },
+        "o": ORIGIN,
+        "cmps": components,
+    }
+    return device_topic(object_id), serialize(payload)
+
+
+def groups_config(mesh: MeshConfig, group_addresses: Iterable[int]) -> Tuple[str, str]:
+    """
+    Build the discovery config of the group lights shared by all instances of
+    a mesh, announced by one of them under the plain bridge device.
+
+    Returns :
+        The discovery topic and the serialized payload.
+    """
+    object_id = "{}bridge".format(mesh.unique_id_prefix)
+    payload = {
+        "dev": {
+            "ids": [object_id],
+            "name": "AwoX mesh {}".format(mesh.id or mesh.name),
+            "mf": "awox-mqtt",
+        },
+        "o": ORIGIN,
+        "cmps": group_components(mesh, group_addresses),
+    }
+    return device_topic(object_id), serialize(payload)
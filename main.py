@@ -2,24 +2,43 @@ import os
 import datetime
 import json
 import logging
-from multiprocessing import Process
 import queue
+import signal
 import struct
 from dotenv import load_dotenv
-from threading import Thread
-from time import sleep
-from typing import Optional, Tuple
+from threading import Lock, Thread, Timer
+from time import sleep, time
+from typing import Callable, List, Optional, Tuple
 
 import paho.mqtt.client as mqtt
 from paho.mqtt.enums import CallbackAPIVersion
 
 import awoxmeshlight_bluepy
+from awoxmeshlight_bluepy.ota import OtaScheduler, parse_ota_request
+from awoxmeshlight_bluepy.supervisor import MeshLightSupervisor
+import discovery
+import pipeline
+import scene
+from profiling import PROFILE_DEFAULT_DURATION, Profiler, timers
+import snapshot
+from snapshot import SnapshotWriter, load_snapshot
+from bleworker import RemoteMeshLight
+from meshconfig import MeshConfig, load_mesh_configs
+from mqttsession import SessionClient
+from ownership import OwnershipCoordinator
 from data import Availability, ColorData, ColorMode, PowerState, StateData
+from subscriptions import SubscriptionManager, skipped_resubscribes
 
 QUEUE_SLEEP_DURATION = datetime.timedelta(milliseconds=25)
 BTDEVICE_NOTIFICATION_TIMEOUT = datetime.timedelta(milliseconds=50)
 COMMAND_QUEUE_TIMEOUT = datetime.timedelta(milliseconds=10)
 NO_RESPONSE_TIMEOUT = datetime.timedelta(seconds=20)
+REPUBLISH_BATCH_SIZE = 50
+REPUBLISH_BATCH_INTERVAL = datetime.timedelta(milliseconds=100)
+NOTIFICATION_BACKLOG = 1024
+STATE_BACKLOG = 1024
+PUBLISH_BACKLOG = 4096
+DIAGNOSTICS_INTERVAL = datetime.timedelta(seconds=60)
 
 logger = logging.getLogger()
 
@@ -41,6 +60,7 @@ def modeFromNumerical(numerical):
         return ColorMode.RGB
 
 
+@timers.timed("parseMessage")
 def parseMessage(message) -> Tuple[int, Optional[Availability], Optional[StateData], bool]:
     unpacked = struct.unpack(20*'B', message)
 
@@ -106,8 +126,8 @@ def parseMessage(message) -> Tuple[int, Optional[Availability], Optional[StateDa
     ), True
 
 
-def get_device_from_file(light_id):
-    with open(AWOX_CLOUD_FILENAME, "r", encoding='utf-8') as file:
+def get_device_from_file(filename, light_id):
+    with open(filename, "r", encoding='utf-8') as file:
         devices = json.loads(file.read())
         for device in devices:
             if int(device["address"]) == int(light_id):
@@ -115,48 +135,255 @@ def get_device_from_file(light_id):
     return None
 
 
-def main():
+def load_devices_from_file(filename):
+    with open(filename, "r", encoding='utf-8') as file:
+        devices = json.loads(file.read())
+    return {int(device["address"]): device for device in devices}
+
+
+def command_key(func, args):
+    # on and off replace each other, other commands only replace their own kind
+    name = "power" if func.__name__ in ("on", "off") else func.__name__
+    return name, args[-1]
+
+
+def mesh_config_from_env() -> MeshConfig:
+    gateway_light_id = os.getenv("MESH_GATEWAY_LIGHTID")
+    return MeshConfig(
+        id="",
+        gateway=os.getenv("MESH_GATEWAY"),
+        gateway_light_id=int(gateway_light_id) if gateway_light_id else None,
+        name=os.getenv("MESH_NAME"),
+        password=os.getenv("MESH_PASSWD"),
+        cloud_filename=os.getenv("AWOX_CLOUD_FILENAME"),
+        snapshot_filename=os.getenv(
+            "SNAPSHOT_FILENAME") or "awox_snapshot.json",
+    )
+
+
+def start_mesh(mesh: MeshConfig, mqtt_client: mqtt.Client,
+               coordinator: Optional[OwnershipCoordinator]) -> Tuple[Callable, Callable, List[Thread]]:
+    """
+    Set up the bridge of one mesh on the shared mqtt client.
+
+    Args :
+        coordinator: Decides which lights this instance handles, None if it
+            is the only instance on the broker.
+
+    Returns :
+        The mqtt connect callback and the republish function of the mesh,
+        and the threads serving it, still to be started.
+    """
     command_queue = queue.Queue()
-    known_light_ids = dict()
+    scenes = dict()
+    devices = load_devices_from_file(mesh.cloud_filename)
+    # suffix of the thread names, the single mesh keeps the plain names
+    thread_suffix = ":{}".format(mesh.id) if mesh.id else ""
+
+    # warm start from the last snapshot, before anything is connected
+    known_light_ids = load_snapshot(mesh.snapshot_filename)
+    logger.info("Loaded {} lights from snapshot.".format(len(known_light_ids)))
+    snapshots = SnapshotWriter(mesh.snapshot_filename, known_light_ids)
 
     # set up light gateway
-    light = awoxmeshlight_bluepy.AwoxMeshLight(
-        MESH_GATEWAY, MESH_NAME, MESH_PASSWD)
-    logger.info("Setup gateway light.")
+    if BLE_WORKER_PROCESS:
+        light = RemoteMeshLight(mesh.gateway, mesh.name, mesh.password)
+        logger.info("Setup gateway light in worker process.")
+    else:
+        light = awoxmeshlight_bluepy.AwoxMeshLight(
+            mesh.gateway, mesh.name, mesh.password)
+        logger.info("Setup gateway light.")
+        light.decrypt_packet = timers.timed(
+            "decrypt_packet")(light.decrypt_packet)
+    light.writeCommand = timers.timed("writeCommand")(light.writeCommand)
+
+    def publish(topic: str, payload: str, retain=False, on_sent: Callable = None):
+        """
+        Args :
+            on_sent: Called without arguments once the client accepted the
+                message, not called if it was dropped.
+        """
+        # serialized by the publish stage, callers never touch the client
+        publish_stage.put((topic, payload, retain, on_sent))
+
+    def send(item):
+        topic, payload, retain, on_sent = item
+        info = subscriptions.publish(topic, payload, retain=retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            logger.warning("Publishing to {} failed: {}".format(
+                topic, mqtt.error_string(info.rc)))
+            return
+        if on_sent is not None:
+            on_sent()
 
-    # set up mqtt client
-    mqtt_client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2)
-    mqtt_client.username_pw_set(MQTT_USER, MQTT_PASSWD)
+    def owns(light_id: int) -> bool:
+        return coordinator is None or \
+            coordinator.owns("{}{}".format(mesh.unique_id_prefix, light_id))
 
     def publishState(light_id: int, data: StateData):
-        if data:
-            mqtt_client.publish(
-                "homeassistant/light/awox_{}/state".format(light_id), data.json(), retain=True)
+        if data and owns(light_id):
+            publish(
+                subscriptions.topic(light_id, "state"), data.json(), retain=True)
 
     def publishAvailability(light_id: int, availability: Availability):
+        if not owns(light_id):
+            return
         logger.info("Light {} ({}): Publish availability: {}".format(
             light_id, known_light_ids[light_id]["name"], availability.value))
-        mqtt_client.publish(
-            "homeassistant/light/awox_{}/availability".format(light_id), availability.value, retain=True)
+        publish(
+            subscriptions.topic(light_id, "availability"), availability.value, retain=True)
+
+    def publishConfig(light_id: int, force=False):
+        light_info = known_light_ids[light_id]
+        topic, payload = discovery.light_config(
+            mesh, light_id, light_info["device"])
+        # keep the serialized config around for republishing
+        light_info["config"] = payload
+        config_hash = discovery.payload_hash(payload)
+        if not owns(light_id):
+            return
+        # the broker still retains an unchanged config
+        if not force and light_info.get("config_hash") == config_hash:
+            return
+
+        def _sent():
+            # only skipped after a restart once the broker got the config
+            light_info["config_hash"] = config_hash
+            snapshots.mark_dirty(light_id)
 
-    def publishConfig(light_id: int, config_payload):
         logger.info("Light {} ({}): Publish config: {}".format(
-            light_id, known_light_ids[light_id]["name"], config_payload))
-        mqtt_client.publish("homeassistant/light/awox_{}/config".format(light_id),
-                            json.dumps(config_payload, ensure_ascii=False), retain=True)
+            light_id, light_info["name"], payload))
+        # only the single mesh predates device based discovery
+        if "config_hash" in light_info or mesh.id:
+            publish(topic, payload, retain=True, on_sent=_sent)
+            return
 
+        # move the entity of the former per entity config over to the
+        # device, in the order home assistant requires for the migration
+        legacy_topic = discovery.legacy_light_topic(
+            "{}{}".format(mesh.unique_id_prefix, light_id))
+        publish(legacy_topic, discovery.MIGRATE_PAYLOAD, retain=True)
+        publish(topic, payload, retain=True)
+        publish(legacy_topic, "", retain=True, on_sent=_sent)
+
+    # hash of the sent bridge and group configs per topic
+    bridge_config_hashes = dict()
+    # lease on announcing the group lights shared by all instances
+    groups_key = "{}groups".format(mesh.unique_id_prefix)
+
+    def groupAddresses():
+        addresses = set()
+        for light_info in list(known_light_ids.values()):
+            addresses |= set(light_info.get("groups", []))
+        return addresses
+
+    def bridgeConfigs() -> List[Tuple[str, str]]:
+        if coordinator is None:
+            return [discovery.bridge_config(mesh, groupAddresses())]
+        configs = [discovery.bridge_config(mesh, set(), INSTANCE_ID)]
+        if coordinator.owns(groups_key):
+            configs.append(discovery.groups_config(mesh, groupAddresses()))
+        return configs
+
+    def publishBridgeConfig(force=False):
+        for topic, payload in bridgeConfigs():
+            config_hash = discovery.payload_hash(payload)
+            if not force and bridge_config_hashes.get(topic) == config_hash:
+                continue
+
+            def _sent(topic=topic, config_hash=config_hash):
+                bridge_config_hashes[topic] = config_hash
+
+            logger.info("Publish bridge config: {}".format(payload))
+            publish(topic, payload, retain=True, on_sent=_sent)
+
+    republish_lock = Lock()
+
+    def republishAll():
+        # serialize everything first, so the burst itself only hands
+        # ready payloads to the client
+        messages = bridgeConfigs()
+        for light_id, light_info in list(known_light_ids.items()):
+            if not "config" in light_info or not owns(light_id):
+                continue
+            messages.append((discovery.device_topic("{}{}".format(
+                mesh.unique_id_prefix, light_id)), light_info["config"]))
+            if light_info.get("availability"):
+                messages.append((subscriptions.topic(light_id, "availability"),
+                                 light_info["availability"].value))
+            if light_info.get("state"):
+                messages.append(
+                    (subscriptions.topic(light_id, "state"), light_info["state"].json()))
+
+        logger.info("Republishing {} messages for {} lights.".format(
+            len(messages), len(known_light_ids)))
+        for index in range(0, len(messages), REPUBLISH_BATCH_SIZE):
+            for topic, payload in messages[index:index + REPUBLISH_BATCH_SIZE]:
+                publish(topic, payload, retain=True)
+            sleep(REPUBLISH_BATCH_INTERVAL.total_seconds())
+
+    def _republish_all():
+        # a second birth message during a running republish is covered by it
+        if not republish_lock.acquire(blocking=False):
+            return
+        try:
+            republishAll()
+        finally:
+            republish_lock.release()
+
+    def announceLight(light_id: int):
+        light_info = known_light_ids[light_id]
+        logger.info("Light {} ({}): Acquired ownership.".format(
+            light_id, light_info.get("name")))
+        subscriptions.add_light(light_id)
+        if "device" in light_info:
+            publishConfig(light_id, force=True)
+        if light_info.get("availability"):
+            publishAvailability(light_id, light_info["availability"])
+        publishState(light_id, light_info.get("state"))
+
+    def releaseLight(light_id: int):
+        logger.info("Light {} ({}): Yielded ownership.".format(
+            light_id, known_light_ids[light_id].get("name")))
+        # the owner serves its set topic now
+        subscriptions.remove_light(light_id)
+
+    def registerLight(light_id: int, fallback=False):
+        if coordinator is not None:
+            coordinator.register("{}{}".format(mesh.unique_id_prefix, light_id),
+                                 lambda: announceLight(light_id),
+                                 lambda: releaseLight(light_id), fallback)
+
+    @timers.timed("handle_notification")
     def handle_notification(_cHandle, data: bytearray):
-        message = light.decrypt_packet(data)
+        # runs inside waitForNotifications, only hand the packet on
+        decode_stage.put((time(), data), block=False)
+
+    @timers.timed("decode_notification")
+    def decode_notification(notification):
+        _received, data = notification
+        # the worker process hands over decrypted packets
+        message = data if BLE_WORKER_PROCESS else light.decrypt_packet(data)
+        if message is None:
+            logger.warning("Dropping notification with invalid checksum.")
+            return None
+
         light_id, availability, state_data, ok = parseMessage(message)
 
         if not ok:
-            return
+            return None
+        return light_id, availability, state_data
+
+    @timers.timed("handle_message")
+    def handle_message(decoded):
+        light_id, availability, state_data = decoded
 
         if not light_id in known_light_ids:
             known_light_ids[light_id] = dict()
 
         if not "name" in known_light_ids[light_id]:
-            device = get_device_from_file(light_id)
+            device = devices.get(light_id) or get_device_from_file(
+                mesh.cloud_filename, light_id)
             if device is None:
                 logger.error(
                     "No light with id {} found in awox cloud data".format(light_id))
@@ -165,71 +392,46 @@ def main():
             # add to known lights
             name = device["displayName"]
             known_light_ids[light_id]["name"] = name
+            known_light_ids[light_id]["device"] = device
 
-            # create config payload to publish
-            config_payload = {
-                "~": "homeassistant/light/awox_{}".format(light_id),
-                # only the device name is relevant
-                "name": "",
-                "device": {
-                    "hw_version": device["hardwareVersion"],
-                    "identifiers": [
-                        "awox_{}".format(light_id)
-                    ],
-                    "manufacturer": device["vendor"],
-                    "model": device["modelName"],
-                    "name": device["displayName"],
-                    "sw_version": device["version"],
-                },
-                "unique_id": "awox_{}".format(light_id),
-                "command_topic": "~/set",
-                "state_topic": "~/state",
-                "availability_topic": "~/availability",
-                "schema": "json",
-                "brightness": True,
-                "color_mode": True,
-                "supported_color_modes": [
-                    "rgb", "color_temp"
-                ]
-            }
-
-            # if we're not handling the gateway, add the via_device option to device info
-            if not light_id == MESH_GATEWAY_LIGHTID:
-                config_payload["device"]["via_device"] = "awox_{}".format(
-                    MESH_GATEWAY_LIGHTID)
-
-            publishConfig(light_id, config_payload)
+            publishConfig(light_id)
+            subscriptions.add_light(light_id)
 
         light_name = known_light_ids[light_id]["name"]
 
+        # the light is reachable through this instance
+        registerLight(light_id)
+
         known_light_ids[light_id]["availability"] = availability
         known_light_ids[light_id]["state"] = state_data
+        snapshots.mark_dirty(light_id)
 
-        if not "availabilityProcess" in known_light_ids[light_id]:
-            known_light_ids[light_id]["availabilityProcess"] = None
+        if not "availabilityTimer" in known_light_ids[light_id]:
+            known_light_ids[light_id]["availabilityTimer"] = None
 
-        def _publish_availability_after_delay(delay: datetime.timedelta, light_id, light_name, availability):
-            logger.info("Light {} ({}): OFFLINE. Scheduling offline message to be sent in {} seconds.".format(
-                light_id, light_name, delay.total_seconds()))
-            sleep(delay.total_seconds())
+        def _publish_availability_after_delay(light_id, availability):
             publishAvailability(light_id, availability)
-            known_light_ids[light_id]["availabilityProcess"] = None
+            known_light_ids[light_id]["availabilityTimer"] = None
 
         logger.info("Light {} ({}): Availability: {}".format(
             light_id, light_name, availability))
+        timer = known_light_ids[light_id]["availabilityTimer"]
         # got "unavailable" message
-        if availability == Availability.OFFLINE:
-            known_light_ids[light_id]["availabilityProcess"] = Process(
-                target=_publish_availability_after_delay, args=(NO_RESPONSE_TIMEOUT, light_id, light_name, availability))
-            known_light_ids[light_id]["availabilityProcess"].start()
+        if availability == Availability.OFFLINE and timer is None:
+            logger.info("Light {} ({}): OFFLINE. Scheduling offline message to be sent in {} seconds.".format(
+                light_id, light_name, NO_RESPONSE_TIMEOUT.total_seconds()))
+            timer = Timer(NO_RESPONSE_TIMEOUT.total_seconds(),
+                          _publish_availability_after_delay, args=(light_id, availability))
+            timer.daemon = True
+            known_light_ids[light_id]["availabilityTimer"] = timer
+            timer.start()
 
         if availability == Availability.ONLINE:
-            process = known_light_ids[light_id]["availabilityProcess"]
-            if isinstance(process, Process) and process.is_alive():
+            if timer is not None and timer.is_alive():
                 logger.info("Light {} ({}): Came back online again. Cancelling publish".format(
                     light_id, light_name))
-                process.kill()
-                known_light_ids[light_id]["availabilityProcess"] = None
+                timer.cancel()
+                known_light_ids[light_id]["availabilityTimer"] = None
             else:
                 publishAvailability(light_id, availability)
 
@@ -238,6 +440,17 @@ def main():
                 light_id, light_name, state_data))
             publishState(light_id, state_data)
 
+    # notifications pass through a decode and a state stage and everything
+    # published through a publish stage, each on its own thread, so reading
+    # and writing on the bluetooth thread never waits for them
+    publish_stage = pipeline.PipelineStage(
+        "publish" + thread_suffix, send, PUBLISH_BACKLOG)
+    state_stage = pipeline.PipelineStage(
+        "handle_message" + thread_suffix, handle_message, STATE_BACKLOG)
+    decode_stage = pipeline.PipelineStage(
+        "decode_notification" + thread_suffix, decode_notification, NOTIFICATION_BACKLOG,
+        downstream=state_stage)
+
     def setPowerstate(light_id, instruction: PowerState):
         if instruction == PowerState.OFF:
             command_queue.put((light.off, light_id))
@@ -295,17 +508,138 @@ def main():
             logger.error("Light {} ({}): Unknown color mode: {}".format(
                 light_id, known_light_ids[light_id]["name"], known_light_ids[light_id]["state"].color_mode))
 
-    light.connect_with_callback(handle_notification)
+    def queueSceneCommand(command: scene.SceneCommand):
+        if command.kind == scene.POWER:
+            func = light.on if command.value == PowerState.ON else light.off
+            command_queue.put((func, command.dest))
+
+        elif command.kind == scene.COLOR:
+            color = command.value
+            command_queue.put(
+                (light.setColor, color.r, color.g, color.b, command.dest))
+
+        elif command.kind == scene.COLOR_TEMP:
+            white_temperature = convert_value_to_available_range(
+                command.value, 153, 500, 0, 127)
+            command_queue.put(
+                (light.setWhiteTemperature, white_temperature, command.dest))
+
+        elif command.kind == scene.COLOR_BRIGHTNESS:
+            color_brightness = convert_value_to_available_range(
+                command.value, 3, 255, 1, 100)
+            command_queue.put(
+                (light.setColorBrightness, color_brightness, command.dest))
+
+        elif command.kind == scene.WHITE_BRIGHTNESS:
+            white_brightness = convert_value_to_available_range(
+                command.value, 3, 255, 1, 127)
+            command_queue.put(
+                (light.setWhiteBrightness, white_brightness, command.dest))
+
+    def applyTargets(name: str, targets):
+        light_commands = dict()
+        for light_id, target in targets.items():
+            if not light_id in devices:
+                logger.warning("{}: Skipping unknown light {}.".format(name, light_id))
+                continue
+            # other instances apply the scene to their own lights
+            if not owns(light_id):
+                continue
+            commands = scene.diff_state(
+                known_light_ids[light_id].get("state"), target)
+            if commands:
+                light_commands[light_id] = commands
+
+        groups = dict()
+        for light_id, light_info in list(known_light_ids.items()):
+            for address in light_info.get("groups", []):
+                groups.setdefault(address, set()).add(light_id)
+
+        plan = scene.plan_commands(
+            light_commands, set(devices.keys()), groups)
+        logger.info("{}: {} lights changed, sending {} commands.".format(
+            name, len(light_commands), len(plan)))
+        for command in plan:
+            queueSceneCommand(command)
+
+        for light_id, commands in light_commands.items():
+            state = scene.apply_state(
+                known_light_ids[light_id].get("state"), commands)
+            if state is None:
+                # only what was sent is known, not retained until the light
+                # reports its whole state
+                publish(subscriptions.topic(light_id, "state"),
+                        json.dumps(scene.partial_state(commands)))
+                continue
+            known_light_ids[light_id]["state"] = state
+            publishState(light_id, state)
+            snapshots.mark_dirty(light_id)
+
+    def handle_mqtt_scene_config_message(_client, _userdata, message: mqtt.MQTTMessage):
+        name = message.topic.split("/")[-2]
+        if not message.payload:
+            scenes.pop(name, None)
+            return
+
+        try:
+            targets, groups = scene.parse_scene(message.payload)
+        except ValueError as e:
+            logger.error("Scene {}: Ignoring invalid config: {}".format(name, e))
+            return
+        scenes[name] = targets
+        for address, members in groups.items():
+            for light_id in members:
+                if not light_id in devices:
+                    logger.warning("Scene {}: Skipping unknown light {} of group {}.".format(
+                        name, light_id, address))
+                    continue
+                known_light_ids[light_id].setdefault(
+                    "groups", set()).add(address)
+                snapshots.mark_dirty(light_id)
+        logger.info("Scene {}: Stored targets for {} lights.".format(
+            name, len(targets)))
+        publishBridgeConfig()
+
+    def handle_mqtt_scene_apply_message(_client, _userdata, message: mqtt.MQTTMessage):
+        name = message.topic.split("/")[-2]
+        if not name in scenes:
+            logger.error("Scene {}: Unknown scene".format(name))
+            return
+        applyTargets("Scene {}".format(name), scenes[name])
+
+    def handle_mqtt_group_set_message(_client, _userdata, message: mqtt.MQTTMessage):
+        try:
+            address = int(message.topic.split("/")[-2])
+            instruction = scene.validate_target(json.loads(message.payload))
+        except ValueError as e:
+            logger.error("Ignoring set on {}: {}".format(message.topic, e))
+            return
+        members = [light_id for light_id, light_info in list(known_light_ids.items())
+                   if address in light_info.get("groups", [])]
+        # merged into group addressed packets where all members need them
+        applyTargets("Group {}".format(address),
+                     {light_id: instruction for light_id in members})
 
     def handle_mqtt_set_message(_client, _userdata, message):
         topic_hierarchy = message.topic.split("/")
         light_uuid = topic_hierarchy[2]
-        if not str(light_uuid).startswith("awox_"):
+        if not str(light_uuid).startswith(mesh.unique_id_prefix):
+            return
+        # cut away the unique id prefix
+        light_id = int(light_uuid[len(mesh.unique_id_prefix):])
+
+        if not owns(light_id):
             return
-        light_id = int(light_uuid[5:])  # cut away awox_ part
 
         instruction = json.loads(message.payload)
 
+        if not light_id in known_light_ids or not known_light_ids[light_id].get("state"):
+            logger.error(
+                "Light {}: No known state yet, ignoring set: {}".format(light_id, instruction))
+            return
+        if not "name" in known_light_ids[light_id] and light_id in devices:
+            known_light_ids[light_id]["name"] = devices[light_id]["displayName"]
+
         logger.info("Light {} ({}): Set: {}".format(
             light_id, known_light_ids[light_id]["name"], instruction))
 
@@ -327,15 +661,17 @@ def main():
         logger.info("Light {} ({}): Create. Publish state: {}".format(
             light_id, known_light_ids[light_id]["name"], known_light_ids[light_id]["state"]))
         publishState(light_id, known_light_ids[light_id]["state"])
+        snapshots.mark_dirty(light_id)
 
     def handle_mqtt_state_message(_client, _userdata, message):
         topic_hierarchy = message.topic.split("/")
         light_uuid = topic_hierarchy[2]
-        if not str(light_uuid).startswith("awox_"):
+        if not str(light_uuid).startswith(mesh.unique_id_prefix):
             return
 
         state = json.loads(message.payload)
-        light_id = int(light_uuid[5:])  # cut away awox_ part
+        # cut away the unique id prefix
+        light_id = int(light_uuid[len(mesh.unique_id_prefix):])
 
         state_data = StateData(
             brightness=state["brightness"],
@@ -352,47 +688,122 @@ def main():
         if not light_id in known_light_ids:
             known_light_ids[light_id] = dict()
         known_light_ids[light_id]["state"] = state_data
+        snapshots.mark_dirty(light_id)
 
     def handle_mqtt_availability_message(_client, _userdata, message: mqtt.MQTTMessage):
         topic_hierarchy = message.topic.split("/")
         light_uuid = topic_hierarchy[2]
-        if not str(light_uuid).startswith("awox_"):
+        if not str(light_uuid).startswith(mesh.unique_id_prefix):
             return
 
         availability = Availability(message.payload.decode())
-        light_id = int(light_uuid[5:])  # cut away awox_ part
+        # cut away the unique id prefix
+        light_id = int(light_uuid[len(mesh.unique_id_prefix):])
 
         if not light_id in known_light_ids:
             known_light_ids[light_id] = dict()
         known_light_ids[light_id]["availability"] = availability
+        snapshots.mark_dirty(light_id)
+
+    subscriptions = SubscriptionManager(
+        mqtt_client,
+        on_set=handle_mqtt_set_message,
+        on_state=handle_mqtt_state_message,
+        on_availability=handle_mqtt_availability_message,
+        prefix=mesh.unique_id_prefix)
+    first_connect = True
+
+    def handle_mqtt_connect(client, userdata, flags, reason_code, properties):
+        nonlocal first_connect
+        subscriptions.on_connect(
+            client, userdata, flags, reason_code, properties)
+        if reason_code.is_failure or not first_connect:
+            return
+        first_connect = False
+
+        # all lights of the catalog and the snapshot are usable right away,
+        # announce the ones the broker doesn't retain yet
+        publishBridgeConfig()
+        for light_id, light_info in list(known_light_ids.items()):
+            if "device" in light_info:
+                publishConfig(light_id)
+
+    subscriptions.add_static("{}/scene/+/config".format(mesh.topic_prefix),
+                             handle_mqtt_scene_config_message)
+    subscriptions.add_static("{}/scene/+/apply".format(mesh.topic_prefix),
+                             handle_mqtt_scene_apply_message)
+    subscriptions.add_static("{}/group/+/set".format(mesh.topic_prefix),
+                             handle_mqtt_group_set_message)
+
+    def publishOtaStatus(mac: str, state: str, acked: int, total: int):
+        publish("{}/ota/status".format(mesh.topic_prefix), json.dumps({
+            "mac": mac, "state": state, "acked": acked, "total": total}))
+
+    # uploads pause while commands for the gateway are waiting
+    ota = OtaScheduler(mesh.name, mesh.password,
+                       idle=command_queue.empty, on_status=publishOtaStatus)
+
+    def handle_mqtt_ota_start_message(_client, _userdata, message: mqtt.MQTTMessage):
+        if not FIRMWARE_DIRECTORY:
+            logger.error("Firmware updates are disabled, set FIRMWARE_DIRECTORY.")
+            return
+        try:
+            path, lights = parse_ota_request(message.payload, FIRMWARE_DIRECTORY)
+            with open(path, "rb") as file:
+                firmware = file.read()
+        except (ValueError, OSError) as e:
+            logger.error("Ignoring firmware update request: {}".format(e))
+            return
+        if not firmware:
+            logger.error("Ignoring firmware update request: {} is empty".format(path))
+            return
 
-    # connect to broker
-    mqtt_client.connect(MQTT_BROKER)
-    logger.info("Connected to broker.")
+        for light_id, mac in lights.items():
+            # every instance gets the request, the owner of the light runs it
+            if not owns(light_id):
+                continue
+            # the gateway can't be connected a second time
+            if mac.upper() == mesh.gateway.upper():
+                logger.error("[{}] Can't update the gateway light.".format(mac))
+                continue
+            logger.info("[{}] Scheduled firmware update of light {}.".format(
+                mac, light_id))
+            ota.enqueue(mac, firmware)
 
-    def process_broker():
-        mqtt_client.loop_forever()
+    subscriptions.add_static("{}/ota/start".format(mesh.topic_prefix),
+                             handle_mqtt_ota_start_message)
 
-    mqtt_client_thread = Thread(target=process_broker)
-    mqtt_client_thread.start()
+    # discovery is generated from the device catalog up front
+    for light_id, device in devices.items():
+        if not light_id in known_light_ids:
+            known_light_ids[light_id] = dict()
+        known_light_ids[light_id]["name"] = device["displayName"]
+        known_light_ids[light_id]["device"] = device
+        # announced by one instance, even if none of them hears the light
+        registerLight(light_id, fallback=True)
 
-    mqtt_topic = "homeassistant/light/+/set"
-    mqtt_client.subscribe(mqtt_topic)
-    mqtt_client.message_callback_add(mqtt_topic, handle_mqtt_set_message)
+    # every instance reaches the groups through its gateway, one announces them
+    if coordinator is not None:
+        coordinator.register(groups_key, lambda: publishBridgeConfig(force=True))
 
-    mqtt_topic = "homeassistant/light/+/state"
-    mqtt_client.subscribe(mqtt_topic)
-    mqtt_client.message_callback_add(mqtt_topic, handle_mqtt_state_message)
+    # subscribe to the lights of the awox cloud data up front, so their
+    # retained state is picked up during the bootstrap window
+    for light_id, light_info in known_light_ids.items():
+        if "name" in light_info:
+            subscriptions.add_light(light_id)
 
-    mqtt_topic = "homeassistant/light/+/availability"
-    mqtt_client.subscribe(mqtt_topic)
-    mqtt_client.message_callback_add(
-        mqtt_topic, handle_mqtt_availability_message)
+    snapshots.start()
+
+    if BLE_WORKER_PROCESS:
+        light.start()
+    else:
+        supervisor = MeshLightSupervisor(light, handle_notification)
+        supervisor.connect()
 
     def process_bluetooth():
         while True:
-            light.btdevice.waitForNotifications(
-                timeout=BTDEVICE_NOTIFICATION_TIMEOUT.total_seconds())
+            if not BLE_WORKER_PROCESS:
+                supervisor.poll(BTDEVICE_NOTIFICATION_TIMEOUT.total_seconds())
             try:
                 items = command_queue.get(
                     timeout=COMMAND_QUEUE_TIMEOUT.total_seconds())
@@ -402,15 +813,178 @@ def main():
 
             # unpack function and arguments from command queue and call it
             func, args = items[0], items[1:]
-            func(*args)
+            if BLE_WORKER_PROCESS:
+                # the worker process supervises and paces the writes itself
+                func(*args)
+                continue
 
+            supervisor.execute(command_key(func, args), func, *args)
             sleep(QUEUE_SLEEP_DURATION.total_seconds())
 
-    bluetooth_thread = Thread(target=process_bluetooth)
-    bluetooth_thread.start()
+    threads = [Thread(target=process_bluetooth,
+                      name="process_bluetooth" + thread_suffix)]
+    threads += [stage.thread for stage in (decode_stage, state_stage, publish_stage)]
+    ota.thread.name = "ota" + thread_suffix
+    threads.append(ota.thread)
+
+    def process_diagnostics():
+        while True:
+            if BLE_WORKER_PROCESS:
+                connected = light.connected
+            else:
+                connected = supervisor.connected
+            publish(discovery.diagnostics_topic(mesh, INSTANCE_ID), json.dumps({
+                "connected": connected,
+                "lights": len(known_light_ids),
+                "dropped": decode_stage.overflows,
+            }))
+            sleep(DIAGNOSTICS_INTERVAL.total_seconds())
+
+    threads.append(Thread(target=process_diagnostics, daemon=True,
+                          name="process_diagnostics" + thread_suffix))
+
+    def process_worker_notifications():
+        while True:
+            notification = light.receive(BTDEVICE_NOTIFICATION_TIMEOUT)
+            if notification is None:
+                continue
+            # the ring buffer holds further notifications while decoding is behind
+            decode_stage.put(notification)
+
+    if BLE_WORKER_PROCESS:
+        threads.append(Thread(target=process_worker_notifications,
+                              name="process_worker_notifications" + thread_suffix))
+
+    return handle_mqtt_connect, _republish_all, threads
+
+
+def main():
+    if MESH_CONFIG_FILENAME:
+        meshes = load_mesh_configs(MESH_CONFIG_FILENAME)
+    else:
+        meshes = [mesh_config_from_env()]
+
+    # set up mqtt client, shared by all meshes
+    if MQTT_V5:
+        # the session on the broker is bound to a stable client id
+        mqtt_client = SessionClient("awox-mqtt-{}".format(INSTANCE_ID or "bridge"))
+    else:
+        mqtt_client = mqtt.Client(
+            callback_api_version=CallbackAPIVersion.VERSION2)
+    mqtt_client.username_pw_set(MQTT_USER, MQTT_PASSWD)
+    subscriptions = SubscriptionManager(mqtt_client)
+
+    coordinator = None
+    if INSTANCE_ID:
+        coordinator = OwnershipCoordinator(mqtt_client, INSTANCE_ID)
+        coordinator.subscribe(subscriptions)
+
+    connect_callbacks = [subscriptions.on_connect]
+    if MQTT_V5:
+        connect_callbacks.insert(0, mqtt_client.on_session_connect)
+        mqtt_client.on_disconnect = mqtt_client.on_session_disconnect
+    republish_functions = []
+    threads = []
+    for mesh in meshes:
+        logger.info("Starting mesh {}.".format(mesh.id or mesh.name))
+        on_connect, republish, mesh_threads = start_mesh(
+            mesh, mqtt_client, coordinator)
+        connect_callbacks.append(on_connect)
+        republish_functions.append(republish)
+        threads += mesh_threads
+
+    def handle_mqtt_connect(client, userdata, flags, reason_code, properties):
+        for callback in connect_callbacks:
+            callback(client, userdata, flags, reason_code, properties)
+
+    def handle_mqtt_birth_message(_client, _userdata, message: mqtt.MQTTMessage):
+        if message.payload.decode() != "online":
+            return
+        logger.info("Home Assistant came online. Republishing all lights.")
+        # republish outside of the network loop, it has to deliver the burst
+        for republish in republish_functions:
+            Thread(target=republish, daemon=True).start()
+
+    profiler = Profiler(["process_broker"] + [thread.name for thread in threads],
+                        PROFILE_DIRECTORY)
+
+    def publishProfile(filename: str):
+        subscriptions.publish("awox/bridge/profile/result", filename)
+
+    def publishTimers():
+        dump = timers.dump()
+        logger.info("Timers: {}".format(dump))
+        subscriptions.publish("awox/bridge/timers", json.dumps(dump))
+        stages = pipeline.dump()
+        logger.info("Pipeline: {}".format(stages))
+        subscriptions.publish("awox/bridge/pipeline", json.dumps(stages))
+        if MQTT_V5:
+            session = mqtt_client.stats(skipped_resubscribes())
+            logger.info("Session: {}".format(session))
+            subscriptions.publish("awox/bridge/session", json.dumps(session))
+
+    def handle_mqtt_profile_message(_client, _userdata, message: mqtt.MQTTMessage):
+        duration = PROFILE_DEFAULT_DURATION
+        try:
+            if message.payload:
+                duration = datetime.timedelta(
+                    seconds=float(message.payload.decode()))
+        except (ValueError, OverflowError):
+            logger.warning("Invalid profile duration {}, profiling for {}.".format(
+                message.payload, PROFILE_DEFAULT_DURATION))
+        if duration.total_seconds() <= 0:
+            duration = PROFILE_DEFAULT_DURATION
+        if not profiler.start(duration, publishProfile):
+            logger.warning("A profile is already running.")
+
+    def handle_mqtt_timers_message(_client, _userdata, _message: mqtt.MQTTMessage):
+        publishTimers()
+
+    # profile without restarting: SIGUSR1 samples the threads, SIGUSR2 dumps the timers
+    signal.signal(signal.SIGUSR1, lambda _signum,
+                  _frame: profiler.start(on_done=publishProfile))
+    signal.signal(signal.SIGUSR2, lambda _signum, _frame: publishTimers())
+
+    def shutdown(signum, _frame):
+        logger.info("Received signal {}, shutting down.".format(signum))
+        # changes since the last snapshot interval are needed for a warm start
+        snapshot.stop_all()
+        if coordinator is not None:
+            coordinator.stop()
+        mqtt_client.disconnect()
+        # the bluetooth and pipeline threads never return on their own
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    mqtt_client.on_connect = handle_mqtt_connect
+    subscriptions.add_static("homeassistant/status", handle_mqtt_birth_message)
+    subscriptions.add_static("awox/bridge/profile/start",
+                             handle_mqtt_profile_message)
+    subscriptions.add_static("awox/bridge/timers/dump",
+                             handle_mqtt_timers_message)
+
+    # connect to broker
+    if MQTT_V5:
+        mqtt_client.connect_session(MQTT_BROKER)
+    else:
+        mqtt_client.connect(MQTT_BROKER)
+    logger.info("Connected to broker.")
+
+    def process_broker():
+        mqtt_client.loop_forever()
+
+    mqtt_client_thread = Thread(target=process_broker, name="process_broker")
+    mqtt_client_thread.start()
+    for thread in threads:
+        thread.start()
+    if coordinator is not None:
+        coordinator.start()
 
     mqtt_client_thread.join()
-    bluetooth_thread.join()
+    for thread in threads:
+        thread.join()
 
 
 if __name__ == "__main__":
@@ -418,13 +992,14 @@ if __name__ == "__main__":
 
     load_dotenv()
 
-    MESH_GATEWAY = os.getenv("MESH_GATEWAY")
-    MESH_GATEWAY_LIGHTID = os.getenv("MESH_GATEWAY_LIGHTID")
-    MESH_NAME = os.getenv("MESH_NAME")
-    MESH_PASSWD = os.getenv("MESH_PASSWD")
-    AWOX_CLOUD_FILENAME = os.getenv("AWOX_CLOUD_FILENAME")
+    MESH_CONFIG_FILENAME = os.getenv("MESH_CONFIG_FILENAME")
+    INSTANCE_ID = os.getenv("INSTANCE_ID")
     MQTT_BROKER = os.getenv("MQTT_BROKER")
     MQTT_USER = os.getenv("MQTT_USER")
     MQTT_PASSWD = os.getenv("MQTT_PASSWD")
+    BLE_WORKER_PROCESS = os.getenv("BLE_WORKER_PROCESS", "0") == "1"
+    PROFILE_DIRECTORY = os.getenv("PROFILE_DIRECTORY") or "."
+    FIRMWARE_DIRECTORY = os.getenv("FIRMWARE_DIRECTORY")
+    MQTT_V5 = os.getenv("MQTT_V5", "0") == "1"
 
     main()
@@ -0,0 +1,61 @@
+import json
+from dataclasses import dataclass
+from typing import List, Optional
+
+
+@dataclass
+class MeshConfig:
+    #: Namespace of the mesh, empty for the single mesh configured through
+    #: the environment, which keeps the plain awox_<light id> unique ids.
+    id: str
+    gateway: str
+    gateway_light_id: Optional[int]
+    name: str
+    password: str
+    cloud_filename: str
+    snapshot_filename: str
+
+    @property
+    def unique_id_prefix(self) -> str:
+        if not self.id:
+            return "awox_"
+        return "awox_{}_".format(self.id)
+
+    @property
+    def topic_prefix(self) -> str:
+        if not self.id:
+            return "awox"
+        return "awox/{}".format(self.id)
+
+
+def load_mesh_configs(filename: str) -> List[MeshConfig]:
+    """
+    Args :
+        filename: A json file in the form
+            {"meshes": [{"id": "...", "gateway": "AA:BB:CC:DD:EE:FF",
+                         "gateway_light_id": 1, "name": "...", "password": "...",
+                         "cloud_filename": "...", "snapshot_filename": "..."}]}
+            snapshot_filename is optional.
+    """
+    with open(filename, "r", encoding='utf-8') as file:
+        meshes = json.loads(file.read())["meshes"]
+
+    configs = []
+    for mesh in meshes:
+        configs.append(MeshConfig(
+            id=mesh["id"],
+            gateway=mesh["gateway"],
+            gateway_light_id=mesh.get("gateway_light_id"),
+            name=mesh["name"],
+            password=mesh["password"],
+            cloud_filename=mesh["cloud_filename"],
+            snapshot_filename=mesh.get(
+                "snapshot_filename", "awox_snapshot_{}.json".format(mesh["id"])),
+        ))
+
+    ids = [config.id for config in configs]
+    assert len(set(ids)) == len(ids), "mesh ids have to be unique"
+    assert all(ids), "mesh ids must not be empty"
+    assert not any(set(id) & set("/+#") for id in ids), \
+        "mesh ids must not contain mqtt topic separators or wildcards"
+    return configs
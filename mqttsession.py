@@ -0,0 +1,121 @@
+import datetime
+import logging
+from threading import Lock
+from time import monotonic
+from typing import Dict
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.enums import CallbackAPIVersion
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+SESSION_EXPIRY = datetime.timedelta(hours=1)
+DIAGNOSTICS_EXPIRY = datetime.timedelta(minutes=2)
+
+#: Topics published often enough to be worth a topic alias.
+ALIASED_SUFFIXES = ("/state",)
+
+#: Transient topics, outdated once the next message is published.
+EXPIRING_SUFFIXES = ("/diagnostics", "/bridge/timers",
+                     "/bridge/pipeline", "/bridge/session", "/ota/status")
+
+#: Size of the topic alias property in a publish packet.
+ALIAS_PROPERTY_SIZE = 3
+
+logger = logging.getLogger(__name__)
+
+
+class SessionClient(mqtt.Client):
+    """
+    An MQTT v5 client keeping its session on the broker across reconnects.
+
+    State topics get a topic alias, once the broker announced how many it
+    accepts. The first publish on a topic binds the alias, later publishes
+    only send the alias instead of the topic. Aliases are only valid for one
+    connection and bound again after every reconnect. Transient diagnostics
+    are published with a message expiry, so the broker doesn't queue them
+    for long.
+    """
+
+    def __init__(self, client_id: str):
+        super().__init__(callback_api_version=CallbackAPIVersion.VERSION2,
+                         client_id=client_id, protocol=mqtt.MQTTv5)
+        self.alias_lock = Lock()
+        self.alias_maximum = 0
+        self.aliases: Dict[str, int] = dict()
+        self.started = monotonic()
+
+        self.aliased_messages = 0
+        self.alias_bytes_saved = 0
+        self.expiring_messages = 0
+
+    def connect_session(self, host: str):
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = int(SESSION_EXPIRY.total_seconds())
+        self.connect(host, clean_start=False, properties=properties)
+
+    def on_session_connect(self, _client, _userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            return
+        with self.alias_lock:
+            self.aliases = dict()
+            self.alias_maximum = getattr(properties, "TopicAliasMaximum", 0)
+        logger.info("Session {}, {} topic aliases available.".format(
+            "resumed" if flags.session_present else "started", self.alias_maximum))
+
+    def on_session_disconnect(self, _client, _userdata, _flags, _reason_code, _properties):
+        with self.alias_lock:
+            self.aliases = dict()
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        if properties is None and topic.endswith(EXPIRING_SUFFIXES):
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.MessageExpiryInterval = int(
+                DIAGNOSTICS_EXPIRY.total_seconds())
+            self.expiring_messages += 1
+
+        if properties is not None or not topic.endswith(ALIASED_SUFFIXES):
+            return super().publish(topic, payload, qos, retain, properties)
+
+        # binding an alias and using it must reach the broker in order
+        with self.alias_lock:
+            alias = self.aliases.get(topic)
+            bound = alias is not None
+            if alias is None and len(self.aliases) < self.alias_maximum \
+                    and self.is_connected():
+                alias = len(self.aliases) + 1
+            if alias is None:
+                return super().publish(topic, payload, qos, retain)
+
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.TopicAlias = alias
+            info = super().publish(
+                "" if bound else topic, payload, qos, retain, properties)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                return info
+
+            if bound:
+                self.aliased_messages += 1
+                self.alias_bytes_saved += len(topic.encode()) - \
+                    ALIAS_PROPERTY_SIZE
+            else:
+                self.aliases[topic] = alias
+                self.alias_bytes_saved -= ALIAS_PROPERTY_SIZE
+            return info
+
+    def stats(self, skipped_resubscribes: int) -> Dict[str, float]:
+        """
+        Args :
+            skipped_resubscribes: Subscriptions kept by the broker across
+                reconnects, each of them spared the resend of its retained
+                messages.
+        """
+        hours = max(monotonic() - self.started, 1) / 3600
+        return {
+            "aliased_messages": self.aliased_messages,
+            "alias_bytes_saved": self.alias_bytes_saved,
+            "alias_bytes_saved_per_hour": round(self.alias_bytes_saved / hours),
+            "skipped_resubscribes": skipped_resubscribes,
+            "skipped_resubscribes_per_hour": round(skipped_resubscribes / hours),
+            "expiring_messages": self.expiring_messages,
+        }
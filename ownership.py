@@ -0,0 +1,200 @@
+import datetime
+import logging
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Callable, Dict, Optional, Set
+
+import paho.mqtt.client as mqtt
+
+HEARTBEAT_INTERVAL = datetime.timedelta(seconds=5)
+HEARTBEAT_TIMEOUT = datetime.timedelta(seconds=20)
+
+INSTANCE_TOPIC = "awox/bridge/instances/{}"
+LEASE_TOPIC = "awox/lease/{}"
+
+#: Marks the lease of a light its owner only knows from the catalog.
+FALLBACK_SUFFIX = "/fallback"
+
+logger = logging.getLogger(__name__)
+
+
+class OwnershipCoordinator:
+    """
+    Coordinates several bridge instances on one broker, so every light is
+    handled by exactly one of them.
+
+    Every instance publishes a retained heartbeat, with a last will marking
+    it offline. A light is owned through a retained lease holding the id of
+    its owner, which stays valid as long as the owner's heartbeat is alive.
+    Instances that can reach a light claim it once the lease is unowned or
+    its owner disappeared. On concurrent claims the smaller instance id wins.
+
+    Lights of the catalog no instance has heard yet are claimed as a
+    fallback, so they are still announced once. Any instance reaching such a
+    light takes it over from the fallback owner.
+    """
+
+    def __init__(self, mqtt_client: mqtt.Client, instance_id: str):
+        self.mqtt_client = mqtt_client
+        self.instance_id = instance_id
+
+        self.lock = Lock()
+        # last heartbeat per instance id
+        self.instances: Dict[str, float] = dict()
+        # owner per lease key
+        self.leases: Dict[str, str] = dict()
+        # keys this instance can serve, with the callback run on acquiring them
+        self.candidates: Dict[str, Callable] = dict()
+        self.releases: Dict[str, Callable] = dict()
+        # candidates only known from the catalog
+        self.fallbacks: Set[str] = set()
+        # leases held as a fallback, by any instance
+        self.fallback_leases: Set[str] = set()
+        self.settled = False
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, name="ownership", daemon=True)
+
+        mqtt_client.will_set(INSTANCE_TOPIC.format(instance_id),
+                             "offline", retain=True)
+
+    def subscribe(self, subscriptions):
+        subscriptions.add_static(INSTANCE_TOPIC.format("+"),
+                                 self.handle_instance_message)
+        subscriptions.add_static(LEASE_TOPIC.format("+"),
+                                 self.handle_lease_message)
+
+    def start(self):
+        self.thread.start()
+
+    def register(self, key: str, on_acquire: Callable,
+                 on_release: Optional[Callable] = None, fallback=False):
+        """
+        Mark the light or group `key` as reachable by this instance.
+
+        Args :
+            on_acquire: Called without arguments once this instance owns the key.
+            on_release: Called without arguments once this instance yielded
+                the key to another instance.
+            fallback: The key is only known from the catalog, it is claimed
+                if no instance reaches it. Registering it again without
+                fallback upgrades it.
+        """
+        with self.lock:
+            if key in self.candidates and (fallback or key not in self.fallbacks):
+                return
+            self.candidates[key] = on_acquire
+            if on_release is not None:
+                self.releases[key] = on_release
+            if fallback:
+                self.fallbacks.add(key)
+            else:
+                self.fallbacks.discard(key)
+        if self.settled:
+            self._claim_orphans()
+
+    def owns(self, key: str) -> bool:
+        return self.leases.get(key) == self.instance_id
+
+    def _alive(self, instance_id: str) -> bool:
+        if instance_id == self.instance_id:
+            return True
+        last_seen = self.instances.get(instance_id)
+        return last_seen is not None and \
+            monotonic() - last_seen < HEARTBEAT_TIMEOUT.total_seconds()
+
+    def _publish_lease(self, key: str):
+        suffix = FALLBACK_SUFFIX if key in self.fallbacks else ""
+        self.mqtt_client.publish(LEASE_TOPIC.format(
+            key), self.instance_id + suffix, retain=True)
+
+    def _claim_orphans(self):
+        claimed = []
+        upgraded = []
+        with self.lock:
+            for key, on_acquire in self.candidates.items():
+                owner = self.leases.get(key)
+                fallback = key in self.fallbacks
+                if owner == self.instance_id:
+                    # reached a light held from the catalog so far
+                    if not fallback and key in self.fallback_leases:
+                        self.fallback_leases.discard(key)
+                        upgraded.append(key)
+                    continue
+                if owner is None or not self._alive(owner) or \
+                        (not fallback and key in self.fallback_leases):
+                    self.leases[key] = self.instance_id
+                    if fallback:
+                        self.fallback_leases.add(key)
+                    else:
+                        self.fallback_leases.discard(key)
+                    claimed.append((key, on_acquire))
+
+        for key in upgraded:
+            self._publish_lease(key)
+        for key, on_acquire in claimed:
+            logger.info("Claiming {}{}".format(
+                key, " as a fallback" if key in self.fallbacks else ""))
+            self._publish_lease(key)
+            on_acquire()
+
+    def handle_instance_message(self, _client, _userdata, message: mqtt.MQTTMessage):
+        instance_id = message.topic.split("/")[-1]
+        if instance_id == self.instance_id:
+            return
+        with self.lock:
+            if message.payload.decode() == "offline":
+                self.instances.pop(instance_id, None)
+                logger.info("Instance {} went offline.".format(instance_id))
+            else:
+                self.instances[instance_id] = monotonic()
+        if self.settled:
+            self._claim_orphans()
+
+    def handle_lease_message(self, _client, _userdata, message: mqtt.MQTTMessage):
+        key = message.topic.split("/")[-1]
+        owner = message.payload.decode()
+        fallback = owner.endswith(FALLBACK_SUFFIX)
+        if fallback:
+            owner = owner[:-len(FALLBACK_SUFFIX)]
+        if owner == self.instance_id or not owner:
+            return
+        with self.lock:
+            # concurrent claim, a light reached beats a light from the
+            # catalog, otherwise the smaller instance id keeps the lease
+            held = self.leases.get(key) == self.instance_id
+            held_fallback = key in self.fallbacks
+            if fallback != held_fallback:
+                wins = fallback
+            else:
+                wins = owner > self.instance_id
+            keep = held and wins and not self.stopped.is_set()
+            if not keep:
+                if held:
+                    logger.info("Yielding {} to {}".format(key, owner))
+                self.leases[key] = owner
+                if fallback:
+                    self.fallback_leases.add(key)
+                else:
+                    self.fallback_leases.discard(key)
+            on_release = self.releases.get(key) if held and not keep else None
+        if keep:
+            self._publish_lease(key)
+        if on_release is not None:
+            on_release()
+
+    def _run(self):
+        # leave the retained leases and heartbeats time to arrive
+        first = True
+        while not self.stopped.is_set():
+            self.mqtt_client.publish(INSTANCE_TOPIC.format(
+                self.instance_id), "online", retain=True)
+            if not first:
+                self.settled = True
+                self._claim_orphans()
+            first = False
+            self.stopped.wait(HEARTBEAT_INTERVAL.total_seconds())
+
+    def stop(self):
+        self.stopped.set()
+        self.mqtt_client.publish(INSTANCE_TOPIC.format(
+            self.instance_id), "offline", retain=True)
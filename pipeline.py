@@ -0,0 +1,82 @@
+import logging
+import queue
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# every stage, for the diagnostics dump
+stages: List["PipelineStage"] = []
+stages_lock = Lock()
+
+
+class PipelineStage:
+    """
+    A bounded queue served by its own thread. The result of the handler, if
+    not None, is passed on to the downstream stage.
+
+    Producers that must never wait, like the bluetooth delegate, put without
+    blocking and the item is dropped and counted when the stage is full.
+    Stages feeding each other block instead, so a slow stage pushes back to
+    its upstream stage and not to the producer.
+    """
+
+    def __init__(self, name: str, handler: Callable, maxsize: int,
+                 downstream: Optional["PipelineStage"] = None):
+        self.name = name
+        self.handler = handler
+        self.downstream = downstream
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.received = 0
+        self.processed = 0
+        self.overflows = 0
+        self.errors = 0
+        self.thread = Thread(target=self._run, name=name, daemon=True)
+
+        with stages_lock:
+            stages.append(self)
+
+    def put(self, item, block=True) -> bool:
+        """
+        Returns :
+            False if the stage was full and the item got dropped.
+        """
+        try:
+            self.queue.put(item, block=block)
+        except queue.Full:
+            self.overflows += 1
+            # don't let the log itself become the bottleneck
+            if self.overflows == 1 or self.overflows % 100 == 0:
+                logger.warning("Stage {} full, dropped {} items.".format(
+                    self.name, self.overflows))
+            return False
+        self.received += 1
+        return True
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                result = self.handler(item)
+            except Exception:
+                self.errors += 1
+                logger.exception("Stage {} failed on {}".format(
+                    self.name, item))
+                continue
+            self.processed += 1
+            if result is not None and self.downstream is not None:
+                self.downstream.put(result)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "received": self.received,
+            "processed": self.processed,
+            "overflows": self.overflows,
+            "errors": self.errors,
+            "backlog": self.queue.qsize(),
+        }
+
+
+def dump() -> Dict[str, dict]:
+    with stages_lock:
+        return {stage.name: stage.stats() for stage in stages}
@@ -0,0 +1,138 @@
+import datetime
+import logging
+import sys
+import threading
+from collections import Counter
+from functools import wraps
+from time import perf_counter_ns, sleep, strftime
+from typing import Callable, Dict, Iterable, List
+
+PROFILE_SAMPLE_INTERVAL = datetime.timedelta(milliseconds=5)
+PROFILE_DEFAULT_DURATION = datetime.timedelta(seconds=30)
+
+logger = logging.getLogger(__name__)
+
+
+class Timers:
+    """
+    Cumulative call counts and durations of instrumented functions.
+    Cheap enough to stay enabled in production.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts: Dict[str, int] = Counter()
+        self.totals: Dict[str, int] = Counter()
+
+    def timed(self, name: str) -> Callable:
+        """
+        Decorator adding the calls of a function to the timer `name`.
+        """
+        def decorator(func: Callable) -> Callable:
+            @wraps(func)
+            def _timed(*args, **kwargs):
+                start = perf_counter_ns()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    elapsed = perf_counter_ns() - start
+                    with self.lock:
+                        self.counts[name] += 1
+                        self.totals[name] += elapsed
+            return _timed
+        return decorator
+
+    def dump(self) -> Dict[str, dict]:
+        with self.lock:
+            return {name: {
+                "count": self.counts[name],
+                "total_ms": round(self.totals[name] / 1e6, 3),
+                "mean_us": round(self.totals[name] / self.counts[name] / 1e3, 3),
+            } for name in self.counts}
+
+
+timers = Timers()
+
+
+def _collapse(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append("{} ({}:{})".format(
+            code.co_name, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def sample_threads(thread_names: Iterable[str], duration: datetime.timedelta) -> Dict[str, Counter]:
+    """
+    Sample the stacks of the named threads for the given duration.
+
+    Returns :
+        The number of samples per collapsed stack, per thread name.
+    """
+    thread_names = set(thread_names)
+    samples = {name: Counter() for name in thread_names}
+    end = perf_counter_ns() + duration.total_seconds() * 1e9
+    while perf_counter_ns() < end:
+        idents = {thread.ident: thread.name for thread in threading.enumerate()
+                  if thread.name in thread_names}
+        for ident, frame in sys._current_frames().items():
+            if ident in idents:
+                samples[idents[ident]][_collapse(frame)] += 1
+        sleep(PROFILE_SAMPLE_INTERVAL.total_seconds())
+    return samples
+
+
+def write_profile(samples: Dict[str, Counter], directory: str) -> str:
+    """
+    Write the samples in the collapsed stack format flame graph tools read,
+    prefixed with the thread name.
+
+    Returns :
+        The filename of the profile.
+    """
+    filename = "{}/awox_profile_{}.txt".format(
+        directory, strftime("%Y%m%d_%H%M%S"))
+    lines: List[str] = []
+    for thread_name, stacks in samples.items():
+        for stack, count in stacks.most_common():
+            lines.append("{};{} {}".format(thread_name, stack, count))
+    with open(filename, "w", encoding='utf-8') as file:
+        file.write("\n".join(lines) + "\n")
+    return filename
+
+
+class Profiler:
+    """
+    Runs at most one sampling profile at a time in a background thread.
+    """
+
+    def __init__(self, thread_names: Iterable[str], directory: str):
+        self.thread_names = list(thread_names)
+        self.directory = directory
+        self.running = threading.Lock()
+
+    def start(self, duration: datetime.timedelta = PROFILE_DEFAULT_DURATION,
+              on_done: Callable = None) -> bool:
+        """
+        Returns :
+            False if a profile is already running.
+        """
+        if not self.running.acquire(blocking=False):
+            return False
+
+        def _profile():
+            try:
+                logger.info("Profiling threads {} for {} seconds.".format(
+                    self.thread_names, duration.total_seconds()))
+                samples = sample_threads(self.thread_names, duration)
+                filename = write_profile(samples, self.directory)
+                logger.info("Wrote profile to {}".format(filename))
+                if on_done:
+                    on_done(filename)
+            finally:
+                self.running.release()
+
+        threading.Thread(target=_profile, name="profiler", daemon=True).start()
+        return True
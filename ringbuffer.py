@@ -0,0 +1,90 @@
+import multiprocessing
+import struct
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional
+
+# write counter, read counter
+HEADER = struct.Struct("<QQ")
+LENGTH = struct.Struct("<H")
+
+
+class RingBuffer:
+    """
+    Single producer, single consumer ring of variable length records in
+    shared memory.
+
+    Records are copied into fixed size slots, so nothing is pickled on the
+    way between processes. A semaphore counts the readable records, which
+    lets the consumer block instead of polling.
+    """
+
+    def __init__(self, capacity: int, slot_size: int, name: Optional[str] = None, items=None):
+        """
+        Args :
+            capacity: The number of slots.
+            slot_size: The size of a slot in bytes, including the length prefix.
+            name: The name of an existing ring to attach to. A new ring is
+                created if None.
+            items: The semaphore counting the readable records of an existing ring.
+        """
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.shm = SharedMemory(name=name, create=name is None,
+                                size=HEADER.size + capacity * slot_size)
+        self.owner = name is None
+        if self.owner:
+            HEADER.pack_into(self.shm.buf, 0, 0, 0)
+        else:
+            # the creating process is responsible for unlinking the memory
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.items = items if items is not None else multiprocessing.Semaphore(0)
+
+    def __reduce__(self):
+        return (RingBuffer, (self.capacity, self.slot_size, self.shm.name, self.items))
+
+    def _slot_offset(self, counter: int) -> int:
+        return HEADER.size + (counter % self.capacity) * self.slot_size
+
+    def put(self, record: bytes) -> bool:
+        """
+        Returns :
+            False if the ring is full and the record was not written.
+        """
+        assert len(record) <= self.slot_size - LENGTH.size, "record too large"
+        written, read = HEADER.unpack_from(self.shm.buf, 0)
+        if written - read >= self.capacity:
+            return False
+
+        offset = self._slot_offset(written)
+        LENGTH.pack_into(self.shm.buf, offset, len(record))
+        start = offset + LENGTH.size
+        self.shm.buf[start:start + len(record)] = record
+        # publish the record only after it has been written completely
+        struct.pack_into("<Q", self.shm.buf, 0, written + 1)
+        self.items.release()
+        return True
+
+    def get(self, timeout: Optional[float] = None) -> Optional[bytes]:
+        """
+        Args :
+            timeout: How long to wait for a record in seconds, 0 to not wait.
+
+        Returns :
+            The oldest record, or None if there was none within the timeout.
+        """
+        if not self.items.acquire(block=timeout != 0, timeout=timeout or None):
+            return None
+
+        read = struct.unpack_from("<Q", self.shm.buf, 8)[0]
+        offset = self._slot_offset(read)
+        length = LENGTH.unpack_from(self.shm.buf, offset)[0]
+        start = offset + LENGTH.size
+        record = bytes(self.shm.buf[start:start + length])
+        struct.pack_into("<Q", self.shm.buf, 8, read + 1)
+        return record
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,222 @@
+import json
+import logging
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from data import ColorData, ColorMode, PowerState, StateData
+
+#: Destination address that reaches every light of the mesh.
+BROADCAST_ADDRESS = 0xffff
+
+# Commands are sent in this order, so power changes land first and the color
+# mode is switched before its brightness is set.
+POWER = "power"
+COLOR = "color"
+COLOR_TEMP = "color_temp"
+COLOR_BRIGHTNESS = "color_brightness"
+WHITE_BRIGHTNESS = "white_brightness"
+COMMAND_ORDER = [POWER, COLOR, COLOR_TEMP, COLOR_BRIGHTNESS, WHITE_BRIGHTNESS]
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SceneCommand:
+    kind: str
+    value: object
+    dest: int
+    light_ids: Set[int]
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def validate_target(target) -> dict:
+    """
+    Args :
+        target: A decoded light state in the json schema home assistant uses.
+
+    Returns :
+        The target.
+
+    Raises :
+        ValueError: The target is no light state.
+    """
+    if not isinstance(target, dict):
+        raise ValueError("light state must be an object, got {!r}".format(target))
+    if "state" in target and target["state"] not in (PowerState.ON.value, PowerState.OFF.value):
+        raise ValueError("invalid state {!r}".format(target["state"]))
+    for key in ("brightness", "color_temp"):
+        if key in target and not _is_int(target[key]):
+            raise ValueError("{} must be an integer".format(key))
+    if "color" in target:
+        color = target["color"]
+        if not isinstance(color, dict) or not all(_is_int(color.get(channel)) for channel in "rgb"):
+            raise ValueError("color must hold integers r, g and b")
+    return target
+
+
+def parse_scene(payload: bytes) -> Tuple[Dict[int, dict], Dict[int, Set[int]]]:
+    """
+    Args :
+        payload: The scene config, in the form
+            {"lights": {"<light id>": <json light state>},
+             "groups": {"<group address>": [<light id>, ...]}}
+
+    Returns :
+        The target state per light id and the members per group address.
+
+    Raises :
+        ValueError: The scene config is malformed.
+    """
+    try:
+        config = json.loads(payload)
+        targets = {int(light_id): validate_target(target)
+                   for light_id, target in config.get("lights", {}).items()}
+        groups = {int(address): set(int(light_id) for light_id in members)
+                  for address, members in config.get("groups", {}).items()}
+    except (TypeError, AttributeError) as e:
+        raise ValueError("malformed scene: {!r}".format(e))
+    return targets, groups
+
+
+def diff_state(current: Optional[StateData], target: dict) -> List[Tuple[str, object]]:
+    """
+    Compute the commands needed to bring a light from its current known state
+    to the target state. Attributes missing in the target are left alone.
+
+    Args :
+        current: The last known state of the light, None if unknown.
+        target: The target state in the json schema home assistant uses.
+    """
+    if target.get("state") == PowerState.OFF.value:
+        if current is None or current.state != PowerState.OFF:
+            return [(POWER, PowerState.OFF)]
+        return []
+
+    commands = []
+    if current is None or current.state != PowerState.ON:
+        commands.append((POWER, PowerState.ON))
+
+    color_mode = current.color_mode if current else None
+    mode_changed = False
+    if "color_temp" in target:
+        color_temp = int(target["color_temp"])
+        if color_mode != ColorMode.COLOR_TEMP or current.color_temp != color_temp:
+            commands.append((COLOR_TEMP, color_temp))
+        mode_changed = color_mode != ColorMode.COLOR_TEMP
+        color_mode = ColorMode.COLOR_TEMP
+
+    elif "color" in target:
+        color = ColorData(
+            target["color"]["r"], target["color"]["g"], target["color"]["b"])
+        if color_mode != ColorMode.RGB or current.color != color:
+            commands.append((COLOR, color))
+        mode_changed = color_mode != ColorMode.RGB
+        color_mode = ColorMode.RGB
+
+    if "brightness" in target and color_mode is None:
+        # white and color brightness are separate commands, without a known
+        # color mode there's no telling which one is meant
+        logger.warning("Ignoring brightness {} for a light in unknown state, "
+                       "add color or color_temp to the target.".format(target["brightness"]))
+    elif "brightness" in target:
+        brightness = int(target["brightness"])
+        if mode_changed or current.brightness != brightness:
+            if color_mode == ColorMode.RGB:
+                commands.append((COLOR_BRIGHTNESS, brightness))
+            else:
+                commands.append((WHITE_BRIGHTNESS, brightness))
+
+    return commands
+
+
+def partial_state(commands: Iterable[Tuple[str, object]]) -> dict:
+    """
+    Returns :
+        The attributes the commands set, in the json schema home assistant
+        uses, for lights without a known state.
+    """
+    state = dict()
+    for kind, value in commands:
+        if kind == POWER:
+            state["state"] = value.value
+            continue
+        state["state"] = PowerState.ON.value
+        if kind == COLOR:
+            state["color_mode"] = ColorMode.RGB.value
+            state["color"] = {"r": value.r, "g": value.g, "b": value.b}
+        elif kind == COLOR_TEMP:
+            state["color_mode"] = ColorMode.COLOR_TEMP.value
+            state["color_temp"] = value
+        else:
+            state["brightness"] = value
+    return state
+
+
+def apply_state(current: Optional[StateData], commands: Iterable[Tuple[str, object]]) -> Optional[StateData]:
+    """
+    Returns :
+        The state the light is in after the commands were executed, None if
+        the state was unknown before.
+    """
+    if current is None:
+        # the next notification of the light reports its whole state
+        return None
+    for kind, value in commands:
+        if kind == POWER:
+            current.state = value
+            continue
+
+        current.state = PowerState.ON
+        if kind == COLOR:
+            current.color_mode = ColorMode.RGB
+            current.color = value
+        elif kind == COLOR_TEMP:
+            current.color_mode = ColorMode.COLOR_TEMP
+            current.color_temp = value
+        else:
+            current.brightness = value
+    return current
+
+
+def plan_commands(light_commands: Dict[int, List[Tuple[str, object]]],
+                  all_light_ids: Set[int],
+                  groups: Dict[int, Set[int]]) -> List[SceneCommand]:
+    """
+    Merge identical commands of several lights into group or broadcast
+    addressed ones and order them by command kind.
+
+    Args :
+        light_commands: The commands per light id, as returned by diff_state.
+        all_light_ids: All light ids of the mesh, used to decide on broadcasts.
+        groups: The members per mesh group address.
+    """
+    merged: Dict[Tuple[str, str], Tuple[str, object, Set[int]]] = dict()
+    for light_id, commands in light_commands.items():
+        for kind, value in commands:
+            key = (kind, repr(value))
+            if not key in merged:
+                merged[key] = (kind, value, set())
+            merged[key][2].add(light_id)
+
+    plan = []
+    for kind, value, light_ids in merged.values():
+        if len(light_ids) > 1 and light_ids == all_light_ids:
+            plan.append(SceneCommand(kind, value, BROADCAST_ADDRESS, light_ids))
+            continue
+
+        remaining = set(light_ids)
+        # prefer the largest groups, a group is only used when all of its
+        # members need the very same command
+        for address, members in sorted(groups.items(), key=lambda group: -len(group[1])):
+            if len(members) > 1 and members <= remaining:
+                plan.append(SceneCommand(kind, value, address, set(members)))
+                remaining -= members
+
+        for light_id in sorted(remaining):
+            plan.append(SceneCommand(kind, value, light_id, {light_id}))
+
+    plan.sort(key=lambda command: COMMAND_ORDER.index(command.kind))
+    return plan
@@ -0,0 +1,182 @@
+import datetime
+import json
+import logging
+import os
+import tempfile
+from dataclasses import asdict
+from threading import Event, Lock, Thread
+from typing import Dict, List
+
+from data import Availability, ColorData, ColorMode, PowerState, StateData
+
+SNAPSHOT_INTERVAL = datetime.timedelta(seconds=5)
+
+logger = logging.getLogger(__name__)
+
+# every writer, flushed on shutdown
+writers: List["SnapshotWriter"] = []
+writers_lock = Lock()
+
+
+def encode_light(light_info: dict) -> dict:
+    entry = dict()
+    for key in ("name", "device", "config_hash"):
+        if key in light_info:
+            entry[key] = light_info[key]
+    if light_info.get("state"):
+        entry["state"] = asdict(light_info["state"])
+    if light_info.get("availability"):
+        entry["availability"] = light_info["availability"].value
+    if light_info.get("groups"):
+        entry["groups"] = sorted(light_info["groups"])
+    return entry
+
+
+def decode_light(entry: dict) -> dict:
+    light_info = dict()
+    for key in ("name", "device", "config_hash"):
+        if key in entry:
+            light_info[key] = entry[key]
+    if "state" in entry:
+        state = entry["state"]
+        light_info["state"] = StateData(
+            brightness=state["brightness"],
+            color=ColorData(**state["color"]),
+            color_mode=ColorMode(state["color_mode"]),
+            color_temp=state["color_temp"],
+            state=PowerState(state["state"]),
+        )
+    if "availability" in entry:
+        light_info["availability"] = Availability(entry["availability"])
+    if "groups" in entry:
+        light_info["groups"] = set(entry["groups"])
+    return light_info
+
+
+def load_snapshot(filename: str) -> Dict[int, dict]:
+    """
+    Returns :
+        The light registry stored in the snapshot, empty if there is no
+        usable snapshot.
+    """
+    try:
+        with open(filename, "r", encoding='utf-8') as file:
+            entries = json.loads(file.read())
+    except FileNotFoundError:
+        return dict()
+    except (OSError, ValueError) as e:
+        logger.error("Ignoring unreadable snapshot {}: {}".format(filename, e))
+        return dict()
+
+    return {int(light_id): decode_light(entry) for light_id, entry in entries.items()}
+
+
+def write_snapshot(filename: str, entries: Dict[int, dict]):
+    # write next to the target and swap it in, a crash never leaves a
+    # half written snapshot behind
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_filename = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding='utf-8') as file:
+            file.write(json.dumps(entries, ensure_ascii=False,
+                                  separators=(",", ":")))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_filename, filename)
+    except:
+        os.unlink(temp_filename)
+        raise
+
+
+class SnapshotWriter:
+    """
+    Persists the light registry in the background. Lights are encoded again
+    when marked dirty, and the file is only rewritten, at most once per
+    interval, if one of the encoded entries actually changed.
+    """
+
+    def __init__(self, filename: str, known_light_ids: Dict[int, dict]):
+        self.filename = filename
+        self.known_light_ids = known_light_ids
+        self.entries = {light_id: encode_light(light_info)
+                        for light_id, light_info in known_light_ids.items()}
+        # lights whose encoding failed, retried on the next flush
+        self.dirty = set()
+        self.changed = False
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+
+        with writers_lock:
+            writers.append(self)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.flush()
+
+    def _update(self, light_id: int):
+        light_info = self.known_light_ids.get(light_id)
+        try:
+            entry = encode_light(light_info) if light_info is not None else None
+        except RuntimeError as e:
+            # the groups are changed on the mqtt thread meanwhile
+            logger.warning("Encoding light {} failed, retrying: {}".format(
+                light_id, e))
+            with self.lock:
+                self.dirty.add(light_id)
+            return
+
+        with self.lock:
+            self.dirty.discard(light_id)
+            if self.entries.get(light_id) == entry:
+                return
+            if entry is None:
+                self.entries.pop(light_id, None)
+            else:
+                self.entries[light_id] = entry
+            self.changed = True
+
+    def mark_dirty(self, light_id: int):
+        self._update(light_id)
+
+    def flush(self):
+        with self.lock:
+            dirty = set(self.dirty)
+        for light_id in dirty:
+            self._update(light_id)
+
+        with self.lock:
+            if not self.changed:
+                return
+            entries = dict(self.entries)
+            self.changed = False
+
+        try:
+            write_snapshot(self.filename, entries)
+        except OSError as e:
+            logger.error("Writing snapshot {} failed: {}".format(
+                self.filename, e))
+            with self.lock:
+                self.changed = True
+
+    def _run(self):
+        while not self.stopped.wait(SNAPSHOT_INTERVAL.total_seconds()):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Snapshot {} failed".format(self.filename))
+
+
+def stop_all():
+    """
+    Stop every writer and write its pending changes.
+    """
+    with writers_lock:
+        stopping = list(writers)
+    for writer in stopping:
+        writer.stop()
@@ -0,0 +1,183 @@
+import datetime
+import logging
+from collections import deque
+from threading import Lock, Timer
+from typing import Callable, Deque, Dict, List, Set
+
+import paho.mqtt.client as mqtt
+
+BOOTSTRAP_DURATION = datetime.timedelta(seconds=5)
+
+#: Payloads remembered per topic, echoes may arrive after newer publishes.
+ECHO_HISTORY = 4
+
+logger = logging.getLogger(__name__)
+
+# every manager, for the session statistics
+managers: List["SubscriptionManager"] = []
+managers_lock = Lock()
+
+
+def light_topic(light_id: int, suffix: str, prefix: str = "awox_") -> str:
+    return "homeassistant/light/{}{}/{}".format(prefix, light_id, suffix)
+
+
+class SubscriptionManager:
+    """
+    Keeps the broker subscriptions limited to the topics of known AwoX lights.
+
+    The `set` topic of every known light stays subscribed for the lifetime of
+    the bridge. The retained `state` and `availability` topics are only
+    subscribed during the bootstrap window after startup, which is long enough
+    for the broker to hand out its retained messages once.
+    """
+
+    def __init__(self, mqtt_client: mqtt.Client,
+                 on_set: Callable = None, on_state: Callable = None,
+                 on_availability: Callable = None, prefix: str = "awox_"):
+        """
+        Args :
+            mqtt_client: The client shared by all meshes.
+            on_set, on_state, on_availability: The callbacks for the topics
+                of a light.
+            prefix: The unique id prefix of the lights.
+        """
+        self.mqtt_client = mqtt_client
+        self.prefix = prefix
+        self.on_set = on_set
+        self.on_state = on_state
+        self.on_availability = on_availability
+
+        self.lock = Lock()
+        self.light_ids: Set[int] = set()
+        self.static_topics: Dict[str, Callable] = dict()
+        self.bootstrapping = True
+        self.bootstrap_timer = None
+        self.connected_once = False
+        # topics the broker holds a subscription for
+        self.broker_topics: Set[str] = set()
+        # topics not subscribed again because the broker kept the session
+        self.skipped_resubscribes = 0
+
+        with managers_lock:
+            managers.append(self)
+
+        # recent payloads the bridge published per topic, used to drop echoes
+        self.published: Dict[str, Deque[bytes]] = dict()
+
+    def _light_topics(self, light_id: int) -> Dict[str, Callable]:
+        topics = {self.topic(light_id, "set"): self.on_set}
+        if self.bootstrapping:
+            topics[self.topic(light_id, "state")] = self._drop_echo(
+                self.on_state)
+            topics[self.topic(light_id, "availability")] = self._drop_echo(
+                self.on_availability)
+        return topics
+
+    def topic(self, light_id: int, suffix: str) -> str:
+        return light_topic(light_id, suffix, self.prefix)
+
+    def _subscribe(self, topics: Dict[str, Callable]):
+        for topic, callback in topics.items():
+            self.mqtt_client.message_callback_add(topic, callback)
+        if topics and self.mqtt_client.is_connected():
+            self.mqtt_client.subscribe([(topic, 0) for topic in topics])
+            self.broker_topics.update(topics)
+
+    def _unsubscribe(self, topics):
+        topics = list(topics)
+        for topic in topics:
+            self.mqtt_client.message_callback_remove(topic)
+        if topics and self.mqtt_client.is_connected():
+            self.mqtt_client.unsubscribe(topics)
+            self.broker_topics.difference_update(topics)
+
+    def _drop_echo(self, callback: Callable) -> Callable:
+        def _callback(client, userdata, message: mqtt.MQTTMessage):
+            if self.is_echo(message):
+                return
+            callback(client, userdata, message)
+        return _callback
+
+    def add_static(self, topic: str, callback: Callable):
+        with self.lock:
+            self.static_topics[topic] = callback
+            self._subscribe({topic: callback})
+
+    def add_light(self, light_id: int):
+        with self.lock:
+            if light_id in self.light_ids:
+                return
+            self.light_ids.add(light_id)
+            logger.debug("Subscribing to topics of light {}".format(light_id))
+            self._subscribe(self._light_topics(light_id))
+
+    def remove_light(self, light_id: int):
+        with self.lock:
+            if not light_id in self.light_ids:
+                return
+            self.light_ids.remove(light_id)
+            logger.debug(
+                "Unsubscribing from topics of light {}".format(light_id))
+            self._unsubscribe(self._light_topics(light_id).keys())
+
+    def _start_bootstrap(self):
+        self.bootstrap_timer = Timer(
+            BOOTSTRAP_DURATION.total_seconds(), self.finish_bootstrap)
+        self.bootstrap_timer.daemon = True
+        self.bootstrap_timer.start()
+
+    def finish_bootstrap(self):
+        with self.lock:
+            if not self.bootstrapping:
+                return
+            topics = []
+            for light_id in self.light_ids:
+                topics.append(self.topic(light_id, "state"))
+                topics.append(self.topic(light_id, "availability"))
+            self._unsubscribe(topics)
+            self.bootstrapping = False
+        logger.info("Retained state bootstrap finished for {} lights.".format(
+            len(self.light_ids)))
+
+    def on_connect(self, _client, _userdata, flags, reason_code, _properties):
+        if reason_code.is_failure:
+            return
+        with self.lock:
+            topics = dict(self.static_topics)
+            for light_id in self.light_ids:
+                topics.update(self._light_topics(light_id))
+            if flags.session_present and self.connected_once:
+                # the broker still has the subscriptions, subscribing again
+                # would only make it resend every retained message
+                kept = self.broker_topics & topics.keys()
+                self.skipped_resubscribes += len(kept)
+                logger.info("Session resumed, keeping {} subscriptions.".format(
+                    len(kept)))
+                self._unsubscribe(self.broker_topics - topics.keys())
+                self._subscribe({topic: callback for topic, callback in topics.items()
+                                 if not topic in kept})
+            else:
+                self.broker_topics = set()
+                self._subscribe(topics)
+            self.connected_once = True
+            # lights added later within the window are bootstrapped as well,
+            # after it every light only keeps its set topic
+            if self.bootstrapping and self.bootstrap_timer is None:
+                self._start_bootstrap()
+
+    def publish(self, topic: str, payload: str, retain=False):
+        encoded = payload.encode()
+        recent = self.published.get(topic)
+        if recent is None:
+            recent = self.published[topic] = deque(maxlen=ECHO_HISTORY)
+        recent.append(encoded)
+        return self.mqtt_client.publish(topic, encoded, retain=retain)
+
+    def is_echo(self, message: mqtt.MQTTMessage) -> bool:
+        return message.payload in self.published.get(message.topic, ())
+
+
+def skipped_resubscribes() -> int:
+    with managers_lock:
+        return sum(manager.skipped_resubscribes for manager in managers)
@@ -0,0 +1,44 @@
+import datetime
+import sys
+from time import sleep, time
+
+import bleworker
+from bleworker import KIND_LINK, NOTIFICATION_RECORD, RemoteMeshLight
+
+
+def crashing_worker(*_args):
+    sys.exit(3)
+
+
+def reporting_worker(_mac, _mesh_name, _mesh_password, _commands, notifications):
+    notifications.put(NOTIFICATION_RECORD.pack(KIND_LINK, time(), b"\x01"))
+    sleep(5)
+
+
+def test_dead_worker_does_not_block_commands(monkeypatch):
+    monkeypatch.setattr(bleworker, "WORKER_RING_CAPACITY", 4)
+    light = RemoteMeshLight("AA:BB:CC:DD:EE:FF", target=crashing_worker)
+    light.start()
+    light.process.join()
+    try:
+        for _ in range(8):
+            light.on()
+        assert light.restarts == 0
+        assert not light.connected
+
+        # restarted once the restart interval passed
+        light.started_at -= bleworker.WORKER_RESTART_INTERVAL.total_seconds()
+        assert light.ensure_alive()
+        assert light.restarts == 1
+    finally:
+        light.close()
+
+
+def test_link_state_is_reported_by_the_worker():
+    light = RemoteMeshLight("AA:BB:CC:DD:EE:FF", target=reporting_worker)
+    light.start()
+    try:
+        assert light.receive(datetime.timedelta(seconds=5)) is None
+        assert light.connected
+    finally:
+        light.close()
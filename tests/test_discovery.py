@@ -0,0 +1,44 @@
+import json
+
+import discovery
+from meshconfig import MeshConfig
+
+DEVICE = {"displayName": "Lamp", "vendor": "AwoX", "modelName": "SML-c9",
+          "version": "1.0", "hardwareVersion": "2.0"}
+
+
+def make_mesh(gateway_light_id):
+    return MeshConfig(id="", gateway="AA:BB:CC:DD:EE:FF",
+                      gateway_light_id=gateway_light_id, name="mesh",
+                      password="secret", cloud_filename="cloud.json",
+                      snapshot_filename="snapshot.json")
+
+
+def device_info(mesh, light_id):
+    _topic, payload = discovery.light_config(mesh, light_id, DEVICE)
+    return json.loads(payload)["dev"]
+
+
+def test_lights_are_announced_via_the_gateway():
+    mesh = make_mesh(1)
+    assert "via_device" not in device_info(mesh, 1)
+    assert device_info(mesh, 2)["via_device"] == "awox_1"
+
+
+def test_no_via_device_without_a_gateway_light():
+    assert "via_device" not in device_info(make_mesh(None), 2)
+
+
+def test_group_lights_are_shared_by_the_instances():
+    mesh = make_mesh(1)
+    topic, payload = discovery.bridge_config(mesh, set(), "a")
+    assert topic == "homeassistant/device/awox_bridge_a/config"
+    assert not any(component["p"] == "light"
+                   for component in json.loads(payload)["cmps"].values())
+
+    topic, payload = discovery.groups_config(mesh, {32770, 32769})
+    assert topic == "homeassistant/device/awox_bridge/config"
+    assert list(json.loads(payload)["cmps"]) == ["awox_group_32769", "awox_group_32770"]
+    # the same ids as the bridge device of a single instance
+    _topic, payload = discovery.bridge_config(mesh, {32769})
+    assert "awox_group_32769" in json.loads(payload)["cmps"]
@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+import pytest
+
+from mqttsession import DIAGNOSTICS_EXPIRY, SessionClient
+
+STATE_TOPIC = "awox/light/awox_12/state"
+
+
+class PublishRecorder:
+    """
+    Stands in for mqtt.Client.publish, recording what reaches the network.
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.properties = []
+        self.rc = mqtt.MQTT_ERR_SUCCESS
+
+    def __call__(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.sent.append((topic, getattr(properties, "TopicAlias", None)))
+        self.properties.append(properties)
+        return SimpleNamespace(rc=self.rc)
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    recorder = PublishRecorder()
+    # a plain function, so it is bound to the client like the real method
+    monkeypatch.setattr(mqtt.Client, "publish",
+                        lambda _client, *args, **kwargs: recorder(*args, **kwargs))
+    return recorder
+
+
+def connected_client(monkeypatch, alias_maximum):
+    client = SessionClient("awox-mqtt-test")
+    monkeypatch.setattr(client, "is_connected", lambda: True)
+    client.on_session_connect(
+        client, None, SimpleNamespace(session_present=False),
+        SimpleNamespace(is_failure=False),
+        SimpleNamespace(TopicAliasMaximum=alias_maximum))
+    return client
+
+
+def test_first_publish_binds_the_alias(monkeypatch, recorder):
+    client = connected_client(monkeypatch, 10)
+    client.publish(STATE_TOPIC, "{}", retain=True)
+    client.publish(STATE_TOPIC, "{}", retain=True)
+    client.publish("awox/light/awox_13/state", "{}", retain=True)
+
+    assert recorder.sent == [(STATE_TOPIC, 1), ("", 1),
+                             ("awox/light/awox_13/state", 2)]
+    assert client.aliased_messages == 1
+
+
+def test_aliases_are_bound_again_after_disconnect(monkeypatch, recorder):
+    client = connected_client(monkeypatch, 10)
+    client.publish(STATE_TOPIC, "{}")
+    client.on_session_disconnect(client, None, None, None, None)
+    client.on_session_connect(
+        client, None, SimpleNamespace(session_present=True),
+        SimpleNamespace(is_failure=False),
+        SimpleNamespace(TopicAliasMaximum=10))
+    client.publish(STATE_TOPIC, "{}")
+
+    assert recorder.sent == [(STATE_TOPIC, 1), (STATE_TOPIC, 1)]
+
+
+def test_failed_publish_binds_no_alias(monkeypatch, recorder):
+    client = connected_client(monkeypatch, 10)
+    recorder.rc = mqtt.MQTT_ERR_NO_CONN
+    client.publish(STATE_TOPIC, "{}")
+    recorder.rc = mqtt.MQTT_ERR_SUCCESS
+    client.publish(STATE_TOPIC, "{}")
+
+    assert recorder.sent == [(STATE_TOPIC, 1), (STATE_TOPIC, 1)]
+
+
+def test_no_aliases_without_broker_support(monkeypatch, recorder):
+    client = connected_client(monkeypatch, 0)
+    client.publish(STATE_TOPIC, "{}")
+    client.publish(STATE_TOPIC, "{}")
+
+    assert recorder.sent == [(STATE_TOPIC, None), (STATE_TOPIC, None)]
+    assert client.aliased_messages == 0
+
+
+def test_diagnostics_expire(monkeypatch, recorder):
+    client = connected_client(monkeypatch, 10)
+    client.publish("awox/bridge/diagnostics", "{}")
+
+    assert recorder.sent == [("awox/bridge/diagnostics", None)]
+    assert recorder.properties[0].MessageExpiryInterval == \
+        DIAGNOSTICS_EXPIRY.total_seconds()
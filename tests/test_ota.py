@@ -0,0 +1,159 @@
+import os
+import struct
+
+import pytest
+from bluepy import btle
+
+from awoxmeshlight_bluepy import ota
+from awoxmeshlight_bluepy import packetutils as pckt
+
+
+def crc16_bitwise(array):
+    crc = 0xffff
+    for val in bytearray(array):
+        for i in range(0, 8):
+            crc = (crc >> 1) ^ (0xa001 if (crc ^ val) & 0x1 else 0)
+            val = val >> 1
+    return crc
+
+
+def test_crc16_table_matches_bitwise():
+    for length in range(0, 64):
+        data = os.urandom(length)
+        assert pckt.crc16(data) == crc16_bitwise(data)
+
+
+class FakeCharacteristic:
+    def __init__(self, peripheral):
+        self.peripheral = peripheral
+
+    def write(self, data, withResponse=False):
+        peripheral = self.peripheral
+        if peripheral.drop_at == peripheral.writes:
+            # the connection dies with packets still in flight
+            peripheral.drop_at = None
+            peripheral.in_flight = []
+            raise btle.BTLEException("connection lost")
+        assert not withResponse
+        peripheral.writes += 1
+        peripheral.in_flight.append(bytes(data))
+
+    def read(self):
+        self.peripheral.process()
+        return b"\x00"
+
+
+class FakePeripheral:
+    """
+    Checks the CRC and the order of every packet once a read acknowledges
+    the packets in flight.
+    """
+
+    def __init__(self, drop_at=None):
+        self.chunks = []
+        self.in_flight = []
+        self.max_in_flight = 0
+        self.writes = 0
+        self.drop_at = drop_at
+        self.finished = False
+
+    def process(self):
+        self.max_in_flight = max(self.max_in_flight, len(self.in_flight))
+        for packet in self.in_flight:
+            index, = struct.unpack("<H", packet[:2])
+            if index == 0xff02:
+                last_index, inverted = struct.unpack("<HH", packet[2:6])
+                assert inverted == ~last_index & 0xffff
+                assert last_index == len(self.chunks) - 1
+                self.finished = True
+                continue
+            assert len(packet) == 20
+            assert struct.unpack("<H", packet[18:])[0] == pckt.crc16(packet[:18])
+            assert index == len(self.chunks), "chunk out of order"
+            self.chunks.append(packet[2:18])
+        self.in_flight = []
+
+    def getCharacteristics(self, uuid):
+        assert uuid == ota.CHARACTERISTIC_UUID_OTA
+        return [FakeCharacteristic(self)]
+
+
+class FakeLight:
+    peripherals = {}
+
+    def __init__(self, mac, _mesh_name, _mesh_password):
+        self.mac = mac
+        self.btdevice = self.peripherals[mac]
+
+    def connect_with_callback(self, _callback):
+        return True
+
+    def disconnect(self):
+        pass
+
+    def forget_characteristics(self):
+        pass
+
+
+def image(chunks):
+    return b"".join(chunks)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(ota, "OTA_RETRY_BACKOFF", ota.datetime.timedelta(0))
+
+
+def test_upload_with_bounded_window():
+    firmware = os.urandom(1000)
+    FakeLight.peripherals["AA:00:00:00:00:01"] = peripheral = FakePeripheral()
+    statuses = []
+    scheduler = ota.OtaScheduler("mesh", "password", idle=lambda: True,
+                                 on_status=lambda *status: statuses.append(status),
+                                 light_factory=FakeLight)
+
+    assert scheduler.update("AA:00:00:00:00:01", firmware)
+    assert peripheral.finished
+    assert peripheral.max_in_flight <= ota.OTA_WINDOW
+    assert image(peripheral.chunks)[:len(firmware)] == firmware
+    assert set(image(peripheral.chunks)[len(firmware):]) <= {0xff}
+    assert statuses[-1] == ("AA:00:00:00:00:01", "done", 63, 63)
+
+
+def test_resume_after_lost_connection():
+    firmware = os.urandom(500)
+    FakeLight.peripherals["AA:00:00:00:00:02"] = peripheral = FakePeripheral(
+        drop_at=13)
+    scheduler = ota.OtaScheduler("mesh", "password", light_factory=FakeLight)
+
+    assert scheduler.update("AA:00:00:00:00:02", firmware)
+    assert peripheral.finished
+    assert image(peripheral.chunks)[:len(firmware)] == firmware
+    # only the 5 chunks of the window in flight are sent again, besides
+    # every chunk and the end packet
+    chunks = len(ota.split_firmware(firmware))
+    assert len(peripheral.chunks) == chunks
+    assert peripheral.writes == chunks + 1 + 5
+
+
+def test_parse_request(tmp_path):
+    (tmp_path / "image.bin").write_bytes(b"\x01")
+    path, lights = ota.parse_ota_request(
+        b'{"firmware": "image.bin", "lights": {"12": "AA:BB:CC:DD:EE:01"}}',
+        str(tmp_path))
+    assert path == os.path.realpath(str(tmp_path / "image.bin"))
+    assert lights == {12: "AA:BB:CC:DD:EE:01"}
+
+
+@pytest.mark.parametrize("payload", [
+    b"not json",
+    b'{"lights": {}}',
+    b'{"firmware": "image.bin", "lights": ["AA:BB:CC:DD:EE:01"]}',
+    b'{"firmware": "../etc/passwd", "lights": {}}',
+    b'{"firmware": "/etc/passwd", "lights": {}}',
+    b'{"firmware": "image.bin", "lights": {"12": "not a mac"}}',
+    b'{"firmware": "image.bin", "lights": {"x": "AA:BB:CC:DD:EE:01"}}',
+])
+def test_parse_request_rejects(tmp_path, payload):
+    with pytest.raises(ValueError):
+        ota.parse_ota_request(payload, str(tmp_path))
@@ -0,0 +1,224 @@
+import ownership
+from ownership import HEARTBEAT_TIMEOUT, INSTANCE_TOPIC, OwnershipCoordinator
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload.encode()
+
+
+class FakeBroker:
+    """
+    Delivers every publish to the handlers of all coordinators right away.
+    Retained messages are replayed to coordinators joining later, like a
+    broker does on subscribe.
+    """
+
+    def __init__(self):
+        self.coordinators = []
+        self.retained = dict()
+
+    def join(self, coordinator):
+        self.coordinators.append(coordinator)
+        for topic, payload in list(self.retained.items()):
+            self.deliver_to(coordinator, topic, payload)
+
+    def drop(self, coordinator):
+        # the connection is lost, the broker publishes the last will
+        self.coordinators.remove(coordinator)
+        topic, payload = coordinator.mqtt_client.will
+        self.publish(topic, payload, retain=True)
+
+    def publish(self, topic, payload, retain):
+        if retain:
+            self.retained[topic] = payload
+        for coordinator in list(self.coordinators):
+            self.deliver_to(coordinator, topic, payload)
+
+    def deliver_to(self, coordinator, topic, payload):
+        message = FakeMessage(topic, payload)
+        if topic.startswith("awox/bridge/instances/"):
+            coordinator.handle_instance_message(None, None, message)
+        else:
+            coordinator.handle_lease_message(None, None, message)
+
+
+class FakeClient:
+    def __init__(self, broker):
+        self.broker = broker
+        self.paused = False
+        self.will = None
+
+    def will_set(self, topic, payload, retain=False):
+        self.will = (topic, payload)
+
+    def publish(self, topic, payload, retain=False):
+        if not self.paused:
+            self.broker.publish(topic, payload, retain)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_instances(monkeypatch, *instance_ids):
+    clock = Clock()
+    monkeypatch.setattr(ownership, "monotonic", clock)
+    broker = FakeBroker()
+    for instance_id in instance_ids:
+        start_instance(broker, instance_id)
+    return clock, broker.coordinators
+
+
+def start_instance(broker, instance_id):
+    coordinator = OwnershipCoordinator(FakeClient(broker), instance_id)
+    broker.join(coordinator)
+    return coordinator
+
+
+def heartbeat(coordinator):
+    # one iteration of the heartbeat thread after the first one
+    coordinator.mqtt_client.publish(INSTANCE_TOPIC.format(
+        coordinator.instance_id), "online", retain=True)
+    coordinator.settled = True
+    coordinator._claim_orphans()
+
+
+def test_concurrent_claims_keep_one_owner(monkeypatch):
+    _clock, (a, b) = make_instances(monkeypatch, "a", "b")
+    acquired = []
+    a.register("awox_1", lambda: acquired.append("a"))
+    b.register("awox_1", lambda: acquired.append("b"))
+
+    # both claim before seeing each other's lease
+    a.mqtt_client.paused = b.mqtt_client.paused = True
+    heartbeat(b)
+    heartbeat(a)
+    assert a.owns("awox_1") and b.owns("awox_1")
+
+    a.mqtt_client.paused = b.mqtt_client.paused = False
+    a._publish_lease("awox_1")
+    b._publish_lease("awox_1")
+    assert a.owns("awox_1")
+    assert not b.owns("awox_1")
+
+
+def test_takeover_after_heartbeat_timeout(monkeypatch):
+    clock, (a, b) = make_instances(monkeypatch, "a", "b")
+    acquired = []
+    a.register("awox_1", lambda: acquired.append("a"))
+    heartbeat(a)
+    b.register("awox_1", lambda: acquired.append("b"))
+    heartbeat(b)
+    assert a.owns("awox_1") and not b.owns("awox_1")
+
+    # a keeps beating within the timeout, b stays away
+    clock.now += HEARTBEAT_TIMEOUT.total_seconds() / 2
+    heartbeat(a)
+    heartbeat(b)
+    assert not b.owns("awox_1")
+
+    # a stops beating
+    a.mqtt_client.paused = True
+    clock.now += HEARTBEAT_TIMEOUT.total_seconds() + 1
+    heartbeat(b)
+    assert b.owns("awox_1")
+    assert acquired == ["a", "b"]
+
+
+def test_takeover_when_owner_goes_offline(monkeypatch):
+    _clock, (a, b) = make_instances(monkeypatch, "a", "b")
+    a.register("awox_1", lambda: None)
+    heartbeat(a)
+    b.register("awox_1", lambda: None)
+    heartbeat(b)
+
+    a.stop()
+    heartbeat(b)
+    assert b.owns("awox_1")
+
+
+def test_restart_respects_retained_leases(monkeypatch):
+    clock, (a, b) = make_instances(monkeypatch, "a", "b")
+    a.register("awox_1", lambda: None)
+    heartbeat(a)
+    b.register("awox_1", lambda: None)
+    heartbeat(b)
+
+    # a crashes, b takes over once the last will arrived
+    broker = a.mqtt_client.broker
+    broker.drop(a)
+    heartbeat(b)
+    assert b.owns("awox_1")
+
+    # the restarted a learns the lease from the retained messages
+    acquired = []
+    a = start_instance(broker, "a")
+    a.register("awox_1", lambda: acquired.append("a"))
+    heartbeat(a)
+    assert not a.owns("awox_1")
+    assert b.owns("awox_1")
+
+    # and takes over once b is gone for good
+    b.mqtt_client.paused = True
+    clock.now += HEARTBEAT_TIMEOUT.total_seconds() + 1
+    heartbeat(a)
+    assert a.owns("awox_1")
+    assert acquired == ["a"]
+
+
+def test_restart_reclaims_own_lease(monkeypatch):
+    _clock, (a, b) = make_instances(monkeypatch, "a", "b")
+    a.register("awox_1", lambda: None)
+    heartbeat(a)
+
+    # a restarts quickly, its retained lease names itself
+    broker = a.mqtt_client.broker
+    broker.coordinators.remove(a)
+    acquired = []
+    a = start_instance(broker, "a")
+    a.register("awox_1", lambda: acquired.append("a"))
+    heartbeat(a)
+    assert a.owns("awox_1")
+    assert acquired == ["a"]
+
+    b.register("awox_1", lambda: None)
+    heartbeat(b)
+    assert not b.owns("awox_1")
+
+
+def test_catalog_lights_are_claimed_once(monkeypatch):
+    _clock, (a, b) = make_instances(monkeypatch, "a", "b")
+    acquired = []
+    a.register("awox_1", lambda: acquired.append("a"), fallback=True)
+    b.register("awox_1", lambda: acquired.append("b"), fallback=True)
+    heartbeat(a)
+    heartbeat(b)
+    assert a.owns("awox_1") and not b.owns("awox_1")
+    assert acquired == ["a"]
+
+
+def test_reaching_a_catalog_light_takes_it_over(monkeypatch):
+    _clock, (a, b) = make_instances(monkeypatch, "a", "b")
+    released = []
+    a.register("awox_1", lambda: None, lambda: released.append("a"),
+               fallback=True)
+    b.register("awox_1", lambda: None, fallback=True)
+    heartbeat(a)
+    heartbeat(b)
+    assert a.owns("awox_1")
+
+    # b hears the light
+    b.register("awox_1", lambda: None)
+    assert b.owns("awox_1") and not a.owns("awox_1")
+    assert released == ["a"]
+
+    # a hearing it later doesn't take it back
+    a.register("awox_1", lambda: None)
+    heartbeat(a)
+    assert b.owns("awox_1") and not a.owns("awox_1")
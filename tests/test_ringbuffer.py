@@ -0,0 +1,42 @@
+import struct
+from multiprocessing import Process
+
+from ringbuffer import RingBuffer
+
+RECORDS = 5000
+
+
+def produce(ring: RingBuffer):
+    for index in range(RECORDS):
+        record = struct.pack("<I", index) * (index % 4 + 1)
+        # spin while the consumer is behind
+        while not ring.put(record):
+            pass
+
+
+def test_records_arrive_in_order_across_processes():
+    ring = RingBuffer(16, 18)
+    producer = Process(target=produce, args=(ring,))
+    producer.start()
+    try:
+        for index in range(RECORDS):
+            record = ring.get(timeout=5)
+            assert record == struct.pack("<I", index) * (index % 4 + 1)
+        assert ring.get(timeout=0) is None
+    finally:
+        producer.join()
+        ring.close()
+
+
+def test_full_ring_rejects_records():
+    ring = RingBuffer(4, 8)
+    try:
+        for index in range(4):
+            assert ring.put(bytes([index]))
+        assert not ring.put(b"x")
+        assert ring.get(timeout=0) == b"\x00"
+        assert ring.put(b"x")
+        assert [ring.get(timeout=0) for _ in range(4)] == [b"\x01", b"\x02", b"\x03", b"x"]
+        assert ring.get(timeout=0) is None
+    finally:
+        ring.close()
@@ -0,0 +1,41 @@
+import pytest
+
+import scene
+from data import ColorData, ColorMode, PowerState, StateData
+
+
+def test_parse_scene():
+    targets, groups = scene.parse_scene(
+        b'{"lights": {"12": {"state": "ON", "brightness": 128}}, "groups": {"32769": [12, 14]}}')
+    assert targets == {12: {"state": "ON", "brightness": 128}}
+    assert groups == {32769: {12, 14}}
+
+
+@pytest.mark.parametrize("payload", [
+    b"not json",
+    b"[]",
+    b'{"lights": {"kitchen": {"state": "ON"}}}',
+    b'{"lights": {"12": "ON"}}',
+    b'{"lights": {"12": {"state": "DIM"}}}',
+    b'{"lights": {"12": {"brightness": "high"}}}',
+    b'{"lights": {"12": {"color": {"r": 1}}}}',
+    b'{"groups": {"32769": 12}}',
+])
+def test_parse_scene_rejects(payload):
+    with pytest.raises(ValueError):
+        scene.parse_scene(payload)
+
+
+def test_unknown_state_is_not_made_up():
+    commands = scene.diff_state(None, {"state": "ON", "color_temp": 300, "brightness": 10})
+    assert scene.apply_state(None, commands) is None
+    assert scene.partial_state(commands) == {
+        "state": "ON", "color_mode": "color_temp", "color_temp": 300, "brightness": 10}
+
+
+def test_only_changes_are_sent():
+    current = StateData(brightness=10, color=ColorData(0, 0, 0),
+                        color_mode=ColorMode.COLOR_TEMP, color_temp=300,
+                        state=PowerState.ON)
+    assert scene.diff_state(current, {"state": "ON", "color_temp": 300, "brightness": 20}) == [
+        (scene.WHITE_BRIGHTNESS, 20)]
@@ -0,0 +1,31 @@
+import os
+
+import snapshot
+from snapshot import SnapshotWriter, load_snapshot
+
+
+def test_unchanged_entries_are_not_written(tmp_path):
+    filename = str(tmp_path / "snapshot.json")
+    registry = {1: {"name": "a"}}
+    writer = SnapshotWriter(filename, registry)
+
+    writer.mark_dirty(1)
+    writer.flush()
+    assert not os.path.exists(filename)
+
+    registry[1]["groups"] = {32769}
+    writer.mark_dirty(1)
+    writer.flush()
+    assert load_snapshot(filename)[1]["groups"] == {32769}
+
+
+def test_pending_changes_are_written_on_shutdown(tmp_path):
+    filename = str(tmp_path / "snapshot.json")
+    registry = {1: {"name": "a"}}
+    writer = SnapshotWriter(filename, registry)
+    writer.start()
+
+    registry[1]["name"] = "b"
+    writer.mark_dirty(1)
+    snapshot.stop_all()
+    assert load_snapshot(filename)[1]["name"] == "b"
@@ -0,0 +1,71 @@
+from subscriptions import SubscriptionManager
+
+
+class FakeClient:
+    def __init__(self):
+        self.connected = True
+        self.callbacks = {}
+        self.subscribed = set()
+
+    def is_connected(self):
+        return self.connected
+
+    def message_callback_add(self, topic, callback):
+        self.callbacks[topic] = callback
+
+    def message_callback_remove(self, topic):
+        self.callbacks.pop(topic, None)
+
+    def subscribe(self, topics):
+        self.subscribed.update(topic for topic, _qos in topics)
+
+    def unsubscribe(self, topics):
+        self.subscribed.difference_update(topics)
+
+    def publish(self, topic, payload, retain=False):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def test_late_echo_is_dropped():
+    received = []
+    manager = SubscriptionManager(
+        FakeClient(), on_state=lambda _client, _userdata, message: received.append(message.payload))
+    manager.add_light(1)
+    topic = manager.topic(1, "state")
+
+    manager.publish(topic, "old")
+    manager.publish(topic, "new")
+    manager.mqtt_client.callbacks[topic](None, None, FakeMessage(topic, b"old"))
+    manager.mqtt_client.callbacks[topic](None, None, FakeMessage(topic, b"foreign"))
+    assert received == [b"foreign"]
+
+
+def test_remove_light_unsubscribes():
+    manager = SubscriptionManager(FakeClient())
+    manager.add_light(1)
+    assert manager.topic(1, "set") in manager.mqtt_client.subscribed
+    manager.remove_light(1)
+    assert not manager.mqtt_client.subscribed
+    assert not manager.mqtt_client.callbacks
+
+
+def test_bootstrap_ends_without_known_lights():
+    manager = SubscriptionManager(FakeClient())
+
+    class Flags:
+        session_present = False
+
+    class ReasonCode:
+        is_failure = False
+
+    manager.on_connect(None, None, Flags, ReasonCode, None)
+    manager.bootstrap_timer.cancel()
+    manager.finish_bootstrap()
+    manager.add_light(1)
+    assert manager.mqtt_client.subscribed == {manager.topic(1, "set")}
@@ -0,0 +1,187 @@
+import datetime
+
+import pytest
+from bluepy import btle
+
+from awoxmeshlight_bluepy import supervisor as supervisor_module
+from awoxmeshlight_bluepy.supervisor import MeshLightSupervisor
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(supervisor_module, "monotonic", clock)
+    return clock
+
+
+class FakeDevice:
+    """
+    A peripheral whose bluepy-helper stays dead once it died, like a
+    bluepy Peripheral.
+    """
+
+    def __init__(self, mesh):
+        self.mesh = mesh
+        self.helper_alive = True
+        self.connected = False
+
+    def check(self):
+        if not self.helper_alive:
+            raise BrokenPipeError("bluepy-helper gone")
+        if not self.connected or not self.mesh.reachable():
+            self.connected = False
+            # what bluepy raises once bluepy-helper died
+            self.helper_alive = False
+            raise BrokenPipeError("bluepy-helper gone")
+
+    def connect(self):
+        if not self.helper_alive:
+            raise BrokenPipeError("bluepy-helper gone")
+        assert not self.connected, "peripheral still connected"
+        if not self.mesh.reachable():
+            raise btle.BTLEException("unreachable")
+        self.connected = True
+
+    def waitForNotifications(self, timeout):
+        self.mesh.clock.advance(timeout)
+        self.check()
+
+    def disconnect(self):
+        if not self.helper_alive:
+            raise BrokenPipeError("bluepy-helper gone")
+        self.connected = False
+
+
+class FakeMesh:
+    """
+    A gateway light whose link is down between `down_at` and `up_at`.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.mac = "AA:BB:CC:DD:EE:FF"
+        self.btdevice = FakeDevice(self)
+        self.down_at = None
+        self.up_at = None
+        self.fail_pairing = False
+        self.connects = 0
+        self.replaced = 0
+        self.written = []
+
+    def reachable(self):
+        now = self.clock()
+        return self.down_at is None or now < self.down_at or now >= self.up_at
+
+    def outage(self, seconds):
+        self.down_at = self.clock()
+        self.up_at = self.down_at + seconds
+
+    def connect_with_callback(self, _callback):
+        self.connects += 1
+        self.btdevice.connect()
+        if self.fail_pairing:
+            raise btle.BTLEException("pairing failed")
+        return True
+
+    def disconnect(self):
+        self.btdevice.disconnect()
+
+    def forget_characteristics(self):
+        pass
+
+    def replace_peripheral(self):
+        self.btdevice = FakeDevice(self)
+        self.replaced += 1
+
+    def write(self, value):
+        self.btdevice.check()
+        self.written.append(value)
+
+
+def make_supervisor(mesh):
+    return MeshLightSupervisor(
+        mesh, lambda _handle, _data: None,
+        min_backoff=datetime.timedelta(milliseconds=10),
+        max_backoff=datetime.timedelta(milliseconds=80),
+        command_expiry=datetime.timedelta(seconds=5))
+
+
+def poll_until_connected(supervisor, clock, limit):
+    deadline = clock() + limit
+    while not supervisor.connected and clock() < deadline:
+        supervisor.poll(0.005)
+        if not supervisor.connected:
+            clock.advance(0.005)
+    return supervisor.connected
+
+
+def test_recovers_and_replays_newest_commands(clock):
+    mesh = FakeMesh(clock)
+    supervisor = make_supervisor(mesh)
+    assert supervisor.connect()
+    supervisor.execute("power", mesh.write, "on")
+
+    mesh.outage(0.3)
+    supervisor.execute("power", mesh.write, "off")
+    supervisor.execute("power", mesh.write, "on")
+    supervisor.execute("color", mesh.write, "red")
+    assert not supervisor.connected
+
+    assert poll_until_connected(supervisor, clock, 2)
+    # recovered within one maximum backoff after the link came back
+    assert 0.3 <= supervisor.last_recovery <= 0.3 + 0.08 + 0.005
+    assert mesh.written == ["on", "on", "red"]
+
+
+def test_expired_commands_are_dropped(clock):
+    mesh = FakeMesh(clock)
+    supervisor = make_supervisor(mesh)
+    supervisor.command_expiry = 0.05
+    assert supervisor.connect()
+
+    mesh.outage(0.2)
+    supervisor.execute("power", mesh.write, "off")
+    assert poll_until_connected(supervisor, clock, 2)
+    assert mesh.written == []
+
+
+def test_failed_pairing_disconnects_the_peripheral(clock):
+    mesh = FakeMesh(clock)
+    mesh.fail_pairing = True
+    supervisor = make_supervisor(mesh)
+    assert not supervisor.connect()
+    assert not mesh.btdevice.connected
+
+    mesh.fail_pairing = False
+    assert poll_until_connected(supervisor, clock, 1)
+    assert mesh.connects == 2
+    assert mesh.replaced == 0
+
+
+def test_broken_peripheral_is_replaced(clock):
+    mesh = FakeMesh(clock)
+    supervisor = make_supervisor(mesh)
+    assert supervisor.connect()
+    broken = mesh.btdevice
+
+    mesh.outage(0.1)
+    supervisor.poll(0.005)
+    assert not supervisor.connected
+    assert not broken.helper_alive
+    assert mesh.btdevice is not broken
+
+    assert poll_until_connected(supervisor, clock, 1)
+    mesh.write("on")
+    assert mesh.replaced == 1
+    assert mesh.written == ["on"]